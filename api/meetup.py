@@ -2,11 +2,20 @@
 Wrapper for Meetup API calls.
 """
 
+import asyncio, time
 import requests
 from html2text import html2text
+from cache import TTLCache
 
 meetup_events = "https://api.meetup.com/{org}/events?&sign=true&photo-host=public&page={limit}"
 
+# Rendered attachments are fresh for five minutes and served stale, while refreshing, for an hour after that.
+# Failures aren't cached.
+_events = TTLCache(ttl=5 * 60, stale=60 * 60, maxsize=32, cacheable=lambda result: result[0])
+
+# Seconds to wait for Meetup.
+timeout = 10
+
 def _make_event_attachment(event):
     """
     Format Meetup event json blob into a slack attachment.
@@ -56,10 +65,18 @@ def events(org, limit):
     Returns `True, [Attachment]` if everything went okay,
             `False, http_status` if something went wrong,
             `False, -1`          if something went really wrong.
+
+    Results are cached, see `_events`.
+    """
+    return _events.get((org, limit), lambda: fetch_events(org, limit))
+
+def fetch_events(org, limit):
+    """
+    Does the work of `events`, without caching.
     """
     try:
         url = meetup_events.format(org=org, limit=limit)
-        rsp = requests.get(url)
+        rsp = requests.get(url, timeout=timeout)
         if rsp.status_code != requests.codes.ok:
             return False, rsp.status_code
         events = rsp.json()
@@ -68,3 +85,69 @@ def events(org, limit):
     except:
         return False, -1
 
+# Loads in progress on each event loop, so that concurrent misses of a key share one request.
+_loading = {}
+
+async def events_async(org, limit):
+    """
+    Like `events`, for use from an asyncio event loop.  Shares its cache.
+
+    Stale entries are refreshed on a thread by the cache, like `events` does,
+    because the loop this is called on may stop running as soon as it returns, see `parser.run_sync`.
+    """
+    key = (org, limit)
+    value, state = _events.lookup(key)
+    if state == 'fresh':
+        return value
+    if state == 'stale':
+        _events._refresh(key, lambda: fetch_events(org, limit))
+        return value
+    return await _load_async(key)
+
+async def _load_async(key):
+    loop = asyncio.get_event_loop()
+    task = _loading.get((loop, key))
+    if task is None:
+        task = _loading[(loop, key)] = asyncio.ensure_future(_fetch_and_cache(key))
+        task.add_done_callback(lambda _: _loading.pop((loop, key), None))
+    # One caller giving up mustn't cancel the load for the others.
+    return await asyncio.shield(task)
+
+async def _fetch_and_cache(key):
+    started = time.monotonic()
+    result = await fetch_events_async(*key)
+    _events.put(key, result, started)
+    return result
+
+_async_sessions = {}
+
+def async_session():
+    """
+    Returns the `aiohttp.ClientSession` for Meetup on the running event loop.
+    """
+    loop = asyncio.get_event_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        import aiohttp
+        session = _async_sessions[loop] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout))
+    return session
+
+async def close_async_session():
+    session = _async_sessions.pop(asyncio.get_event_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+async def fetch_events_async(org, limit):
+    """
+    Does the work of `events_async`, without caching.
+    """
+    try:
+        url = meetup_events.format(org=org, limit=limit)
+        async with async_session().get(url) as rsp:
+            if rsp.status != 200:
+                return False, rsp.status
+            events = await rsp.json()
+        attachments = [_make_event_attachment(event) for event in events]
+        return True, attachments
+    except:
+        return False, -1
@@ -2,30 +2,107 @@
 Wrapper for Slack API calls.
 """
 
-import logging, json
+import logging, json, threading, time, queue, asyncio, functools
+from collections import OrderedDict, deque
 import requests
+from requests.adapters import HTTPAdapter
+import metrics, tracing
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('api')
 logger.setLevel(logging.DEBUG)
 
 token = None
+base_url = "https://slack.com/api/"
 
-def call(method, **kwargs):
+# Connection pool settings, applied by `configure`.  The endpoint and the sysproxy read them from
+# `SLACK_POOL_SIZE`, `SLACK_CONNECT_TIMEOUT` and `SLACK_READ_TIMEOUT` at startup.
+pool_size = 10
+timeout = (3.05, 10)
+
+# When set to a running `Scheduler`, `respond` queues messages on it instead of sending them itself.
+scheduler = None
+
+call_seconds = metrics.Histogram('slack_call_seconds', "Latency of Slack Web API calls, by method and HTTP status.", labels=('method', 'status'))
+
+_session = None
+_session_lock = threading.Lock()
+_in_flight = 0
+
+class RateLimited(Exception):
+    """Raised when Slack answers a call with HTTP 429."""
+    def __init__(self, method, retry_after):
+        super().__init__(f"Rate limited calling {method}, retry after {retry_after}s.")
+        self.method = method
+        self.retry_after = retry_after
+
+def configure(size=None, connect_timeout=None, read_timeout=None):
     """
-    Perform a Slack Web API call. It is supposed to have roughly the same
-    semantics as the official slackclient Python library.
+    Changes the connection pool settings.  The pool is recreated on the next call.
+    """
+    global pool_size, timeout, _session
+    if size is not None:
+        pool_size = size
+    if connect_timeout is not None or read_timeout is not None:
+        timeout = (connect_timeout or timeout[0], read_timeout or timeout[1])
+    with _session_lock:
+        old, _session = _session, None
+    if old:
+        old.close()
 
-    This does some magic "fixups" of the outbound data.
+def session():
     """
+    Returns the shared `requests.Session`, which keeps connections to Slack alive between calls.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            _session.mount(base_url, adapter)
+        return _session
+
+def pool_stats():
+    """
+    Counts of requests made and connections opened by the pool.
+    `reuse` is the fraction of requests that didn't need a new connection.
+    """
+    requests_made = connections = 0
+    with _session_lock:
+        if _session is not None:
+            adapter = _session.get_adapter(base_url)
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                requests_made += pool.num_requests
+                connections += pool.num_connections
+    return {
+        'size' : pool_size,
+        'requests' : requests_made,
+        'connections' : connections,
+        'reuse' : 1 - connections / requests_made if requests_made else 0.0,
+        'in_flight' : _in_flight,
+    }
+
+def _post(url, data):
+    global _in_flight
+    with _session_lock:
+        _in_flight += 1
+    try:
+        return session().post(url, data=data, timeout=timeout)
+    finally:
+        with _session_lock:
+            _in_flight -= 1
+
+def _prepare(kwargs):
     kwargs['token'] = token
     if 'attachments' in kwargs:
         # I do not fully understand why this is necessary.
         # but attachments do not show up unless we do this.
         kwargs['attachments'] = json.dumps(kwargs['attachments'])
-    r = requests.post("https://slack.com/api/" + method, data=kwargs)
-    r.raise_for_status()
-    response = r.json()
+    return {key : value for (key, value) in kwargs.items() if value is not None}
+
+def _check(response):
     if not response.get('ok'):
         logger.error(f"Slack error: {response.get('error')}")
         raise Exception(f"Slack error: {response.get('error')}")
@@ -35,10 +112,69 @@ def call(method, **kwargs):
 
     return response
 
-def respond(msg, text, **kwargs):
+def call(method, **kwargs):
     """
-    Respond to a message by posting to the channel the request originates from.
+    Perform a Slack Web API call. It is supposed to have roughly the same
+    semantics as the official slackclient Python library.
+
+    This does some magic "fixups" of the outbound data.
+    """
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        r = _post(base_url + method, _prepare(kwargs))
+        status = str(r.status_code)
+    finally:
+        call_seconds.observe(time.perf_counter() - started, (method, status))
+    if r.status_code == 429:
+        retry_after = float(r.headers.get('Retry-After', 1))
+        logger.warning(f"Slack rate limited {method} for {retry_after}s.")
+        raise RateLimited(method, retry_after)
+    r.raise_for_status()
+    return _check(r.json())
+
+_async_sessions = {}
+
+def async_session():
+    """
+    Returns the `aiohttp.ClientSession` used by `call_async` on the running event loop.
+    Every loop gets its own, because a session can only be used from the loop it was created on.
+    aiohttp is only imported once this is used.
     """
+    loop = asyncio.get_event_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        import aiohttp
+        session = _async_sessions[loop] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1]))
+    return session
+
+async def close_async_session():
+    session = _async_sessions.pop(asyncio.get_event_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+async def call_async(method, **kwargs):
+    """
+    Like `call`, for use from an asyncio event loop.
+    """
+    started = time.perf_counter()
+    status = 'error'
+    try:
+        async with async_session().post(base_url + method, data=_prepare(kwargs)) as r:
+            status = str(r.status)
+            if r.status == 429:
+                retry_after = float(r.headers.get('Retry-After', 1))
+                logger.warning(f"Slack rate limited {method} for {retry_after}s.")
+                raise RateLimited(method, retry_after)
+            r.raise_for_status()
+            response = await r.json()
+    finally:
+        call_seconds.observe(time.perf_counter() - started, (method, status))
+    return _check(response)
+
+def _reply(msg, text, kwargs):
     if 'text' in kwargs:
         logger.warn(f'"text" given as kwarg: {kwargs["text"]}')
     if 'channel' in kwargs:
@@ -50,7 +186,186 @@ def respond(msg, text, **kwargs):
             kwargs['thread_ts'] = msg['thread_ts']
     kwargs['text'] = text
     kwargs['channel'] = msg['channel']
-    return call('chat.postMessage', **kwargs)
+    return kwargs
+
+def respond(msg, text, sync=False, block=True, **kwargs):
+    """
+    Respond to a message by posting to the channel the request originates from.
+
+    If a `scheduler` is running the message is queued on it and `None` is returned,
+    unless `sync` is set, in which case the message is sent right away and Slack's response returned.
+    Queuing waits for room in the channel's queue, unless `block` is false, in which case a full queue raises `queue.Full`.
+    """
+    context = msg.get('trace')
+    kwargs = _reply(msg, text, kwargs)
+    if scheduler is not None and not sync:
+        scheduler.submit('chat.postMessage', block=block, done=tracing.recorder(context, 'slack_post', queued=True), **kwargs)
+        return None
+    with tracing.span(context, 'slack_post', queued=False):
+        return call('chat.postMessage', **kwargs)
+
+async def respond_async(msg, text, sync=False, **kwargs):
+    """
+    Like `respond`, for use from an asyncio event loop.
+
+    A message for the `scheduler` is queued without blocking the loop.  If the channel's queue is full,
+    the wait for room happens in the loop's default executor instead.
+    """
+    context = msg.get('trace')
+    kwargs = _reply(msg, text, kwargs)
+    if scheduler is not None and not sync:
+        submit = functools.partial(scheduler.submit, 'chat.postMessage', done=tracing.recorder(context, 'slack_post', queued=True), **kwargs)
+        try:
+            submit(block=False)
+        except queue.Full:
+            await asyncio.get_event_loop().run_in_executor(None, submit)
+        return None
+    with tracing.span(context, 'slack_post', queued=False):
+        return await call_async('chat.postMessage', **kwargs)
+
+class _Channel:
+    def __init__(self, tokens):
+        self.queue = deque()
+        self.tokens = tokens
+        self.refilled = time.monotonic()
+        self.blocked_until = 0.0
+
+class Scheduler:
+    """
+    Sends calls from a background thread, keeping each channel within Slack's rate limit.
+
+    Every channel has its own queue of at most `maxsize` calls and a token bucket that allows
+    `rate` calls per second with bursts of up to `burst`.  Channels are served round robin.
+    A `RateLimited` call is put back at the front of its queue and the channel is paused for `Retry-After` seconds.
+    `submit` blocks, like `queue.Queue.put`, while the channel's queue is full.
+    """
+
+    def __init__(self, rate=1.0, burst=3, maxsize=100):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._channels = OrderedDict()
+        self._cond = threading.Condition()
+        self._sent = 0
+        self._failed = 0
+        self._rate_limited = 0
+        self._in_flight = 0
+
+    def start(self):
+        threading.Thread(target=self._run, name="slack-scheduler", daemon=True).start()
+        return self
+
+    def submit(self, method, block=True, timeout=None, done=None, **kwargs):
+        """
+        Queues a call.  Raises `queue.Full` if it can't be queued within `timeout` seconds.
+        `done`, if given, is called with `ok=True` or `ok=False` once the call has been made.
+        """
+        channel = kwargs.get('channel')
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            state = self._channel(channel)
+            while len(state.queue) >= self.maxsize:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Full()
+                self._cond.wait(remaining)
+            state.queue.append((method, kwargs, done))
+            self._cond.notify_all()
+
+    def _channel(self, channel):
+        """
+        The state of `channel`, which is created if it has none.  Call with `_cond` held.
+        """
+        state = self._channels.get(channel)
+        if state is None:
+            state = self._channels[channel] = _Channel(self.burst)
+        return state
+
+    def room(self, channel):
+        """
+        How many more calls for `channel` can be queued without blocking.
+        """
+        with self._cond:
+            state = self._channels.get(channel)
+            return self.maxsize - (len(state.queue) if state else 0)
+
+    def drain(self, timeout=None):
+        """
+        Waits until every queued call has been made.  Returns `False` if some are still queued after `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._in_flight or any(state.queue for state in self._channels.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._cond:
+            return {
+                'sent' : self._sent,
+                'failed' : self._failed,
+                'rate_limited' : self._rate_limited,
+                'queued' : {channel : len(state.queue) for (channel, state) in self._channels.items() if state.queue},
+            }
+
+    def _next(self, now):
+        """
+        Pops the next call that may be sent now, or returns how long to wait for one.
+        """
+        wait = None
+        for channel, state in list(self._channels.items()):
+            state.tokens = min(self.burst, state.tokens + (now - state.refilled) * self.rate)
+            state.refilled = now
+            if not state.queue:
+                if state.tokens >= self.burst:
+                    del self._channels[channel]
+                continue
+            if now >= state.blocked_until and state.tokens >= 1:
+                state.tokens -= 1
+                self._channels.move_to_end(channel)
+                return state.queue.popleft(), None
+            ready = max(state.blocked_until - now, (1 - state.tokens) / self.rate)
+            wait = ready if wait is None else min(wait, ready)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job, wait = self._next(time.monotonic())
+                while job is None:
+                    self._cond.wait(wait)
+                    job, wait = self._next(time.monotonic())
+                self._in_flight += 1
+                # Wake anyone waiting for room in the queue.
+                self._cond.notify_all()
+            method, kwargs, done = job
+            try:
+                call(method, **kwargs)
+                with self._cond:
+                    self._sent += 1
+                if done:
+                    done(ok=True)
+            except RateLimited as ex:
+                with self._cond:
+                    self._rate_limited += 1
+                    # The channel's state may have been dropped by `_next` while the call was in flight,
+                    # and a new one created by `submit`, so look it up again.
+                    state = self._channel(kwargs.get('channel'))
+                    state.blocked_until = time.monotonic() + ex.retry_after
+                    state.queue.appendleft((method, kwargs, done))
+            except:
+                logger.exception(f"Scheduled {method} call failed.")
+                with self._cond:
+                    self._failed += 1
+                if done:
+                    done(ok=False)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
 
 def datetime_to_slacktime(dt):
     ts = str(dt.timestamp())[:10]
@@ -0,0 +1,574 @@
+"""
+Replays Slack messages through `endpoint.handle_post` and `hmbot.handle_message` and times them.
+
+Slack, Meetup and the sysproxy queue are replaced by local fakes, which still do the outbound encoding
+(`api.slack._prepare`, `channel.encode`) but never touch the network.  Events are handled inline.
+
+Inputs are JSON lines, each one of:
+
+  * a Slack Events API payload (`{"type": "event_callback", "event": {...}}`),
+  * a message event, or anything with a `text` (`{"text": "hi hmbot"}`),
+  * a backlog entry like the ones in `requests.jsonl`, whose `title` and `body` are replayed as two messages.
+
+Without inputs a few built-in commands are replayed, together with `requests.jsonl` if it exists.
+
+Time is split into phases per message:
+
+  * `tokenize`: the tokenizer,
+  * `handler`: the action that matched, minus its outbound calls,
+  * `outbound`: the fake Slack, Meetup and queue calls,
+  * `dispatch`: everything else, i.e. deduplication, the prefilter, finding candidates and matching rules.
+
+Usage:
+
+    python bench.py [inputs...] [--repeat N] [--output results.json] [--compare baseline.json]
+
+`--compare` prints the change in every percentile against an earlier `--output`
+and exits with 1 if the p99 of any phase got more than `--threshold` percent slower.
+
+    python bench.py --loops [--samples N]
+
+instead compares the sysproxy's reactor with the loop it replaced, which polled the command socket without blocking
+and otherwise `select`ed on the PTYs for up to a second and slept for 0.1s.  Both run in this process
+on an `inproc://` command socket, and measure
+
+  * `command`: the round trip of a `ps` request,
+  * `output`: from sending a line to a `cat` process until its echo is posted.
+
+Output isn't coalesced during this comparison, since the old loop posted everything as soon as it was read.
+
+    python bench.py --channel [--samples N]
+
+measures the command channel from the endpoint to the sysproxy: the size and encoding time of a command,
+how many commands per second one sender gets through, and the round trip of a request and its acknowledgement.
+The old channel, `send_json` of the whole command over PUSH/PULL on TCP, is measured alongside.
+"""
+
+import argparse, asyncio, functools, itertools, json, logging, os, random, select, subprocess, sys, tempfile, threading, time
+from contextlib import contextmanager
+
+os.environ.setdefault('SQLITE_DB', os.path.join(tempfile.mkdtemp(prefix='hmbot-bench-'), 'bench.db'))
+os.environ.setdefault('SLACK_TOKEN', 'xoxb-bench')
+os.environ.setdefault('VERIFICATION_TOKEN', 'bench')
+
+import zmq
+import endpoint, hmbot, channel, parser, api.slack, api.meetup
+
+phases = ('tokenize', 'dispatch', 'handler', 'outbound', 'total')
+
+# Numbers the replayed events, across all replays.
+event_numbers = itertools.count()
+
+sample_messages = (
+    "hi hmbot",
+    "hmbot, help!",
+    "hey hmbot, can you please choose between pizza, tacos, ramen",
+    "hmbot rechoose from: tea, coffee",
+    "Yo hmbot, what are the happs?",
+    "hmbot lets play zork",
+    "> look around",
+    "# ps",
+    "# kill 1234",
+    "I am hmbot",
+    "hmbot i love you",
+    "nobody is talking to the bot here, this should be rejected early",
+    "what's everyone doing for lunch?",
+)
+
+meetup_events = [{
+    'time' : 1546300800000 + i * 86400000,
+    'name' : f"Hack Night {i}",
+    'link' : "https://www.meetup.com/hackmanhattan/",
+    'description' : "<p>Come <b>hack</b> with us.</p>",
+    'venue' : {'name' : "Hack Manhattan", 'address_1' : "137 W 14th St"},
+    'yes_rsvp_count' : 12,
+} for i in range(5)]
+
+class Phases:
+    """
+    Accumulates the time spent in each phase while handling one message.
+    """
+
+    def __init__(self):
+        self.current = None
+
+    def start(self):
+        self.current = dict.fromkeys(phases, 0.0)
+
+    @contextmanager
+    def measure(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.current is not None:
+                self.current[phase] += time.perf_counter() - started
+
+    def timed(self, phase, func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.measure(phase):
+                    return await func(*args, **kwargs)
+            return wrapper
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.measure(phase):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def finish(self):
+        sample, self.current = self.current, None
+        sample['handler'] -= sample['outbound']
+        sample['dispatch'] = sample['total'] - sample['tokenize'] - sample['handler'] - sample['outbound']
+        return sample
+
+class FakeResponse:
+    status_code = 200
+    headers = {}
+
+    def __init__(self, body):
+        self._body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._body
+
+class FakeQueue:
+    """
+    Stands in for `channel.Client`, acknowledging every command as an idle sysproxy would.
+    """
+
+    def __init__(self, timed):
+        self.sent = 0
+        self.request = timed(self.request)
+        self.broadcast = timed(self.broadcast)
+
+    def request(self, command, timeout=None):
+        channel.encode(command)
+        self.sent += 1
+        return self._ack(command)
+
+    def broadcast(self, command, timeout=None):
+        return [self.request(command, timeout)]
+
+    def _ack(self, command):
+        results = {
+            'ps' : {'processes' : []},
+            'kill' : {'killed' : False},
+            'create' : {'created' : True},
+        }
+        return dict(results.get(command['command'], {}), id=self.sent, ok=True)
+
+def install_fakes(timer):
+    """
+    Replaces everything that would leave the process, and wraps the parts to be timed.
+    """
+    def post(url, data):
+        return FakeResponse({'ok' : True, 'ts' : str(time.time())})
+    api.slack._post = timer.timed('outbound', post)
+    api.slack.scheduler = None
+
+    async def call_async(method, **kwargs):
+        api.slack._prepare(kwargs)
+        return {'ok' : True, 'ts' : str(time.time())}
+    api.slack.call_async = timer.timed('outbound', call_async)
+
+    def fetch_events(org, limit):
+        return True, [api.meetup._make_event_attachment(event) for event in meetup_events[:limit]]
+    api.meetup.fetch_events = timer.timed('outbound', fetch_events)
+
+    async def fetch_events_async(org, limit):
+        return True, [api.meetup._make_event_attachment(event) for event in meetup_events[:limit]]
+    api.meetup.fetch_events_async = timer.timed('outbound', fetch_events_async)
+
+    hmbot.parser.tokenize = timer.timed('tokenize', hmbot.parser.tokenize)
+    hmbot.parser.handlers = [
+        parser.make_handler(h.rules, timer.timed('handler', h.func), hmbot.parser.ignore, hmbot.parser.remove)
+        for h in hmbot.parser.handlers
+    ]
+
+    endpoint.pool = None
+    endpoint.queue = FakeQueue(lambda func: timer.timed('outbound', func))
+
+def load_messages(paths):
+    """
+    Reads the inputs and returns the Slack events they describe.
+    """
+    if not paths:
+        events = [{'text' : text} for text in sample_messages]
+        if os.path.exists('requests.jsonl'):
+            events.extend(read_jsonl('requests.jsonl'))
+        return events
+    events = []
+    for path in paths:
+        events.extend(read_jsonl(path))
+    return events
+
+def read_jsonl(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry.get('type') == 'event_callback':
+                events.append(entry['event'])
+            elif 'text' in entry:
+                events.append(entry)
+            else:
+                events.extend({'text' : entry[key]} for key in ('title', 'body') if entry.get(key))
+    return events
+
+def payload(event, i):
+    """
+    Wraps `event` into a fresh Events API payload, so that deduplication doesn't skip repeats.
+    """
+    ts = f"{1546300800 + i}.{i % 1000000:06d}"
+    event = dict({
+        'type' : 'message',
+        'channel' : 'C0BENCH',
+        'user' : 'U0BENCH',
+        'ts' : ts,
+        'thread_ts' : ts,
+    }, **event)
+    return {
+        'token' : endpoint.verification_token,
+        'type' : 'event_callback',
+        'event_id' : f"Ev{i:08d}",
+        'event' : event,
+    }
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+def replay(events, repeat, timer):
+    samples = []
+    started = time.perf_counter()
+    for i in range(repeat * len(events)):
+        message = payload(events[i % len(events)], next(event_numbers))
+        timer.start()
+        with timer.measure('total'):
+            try:
+                endpoint.handle_post(message)
+            except:
+                logging.getLogger('bench').exception(f"Error handling {message}")
+        samples.append(timer.finish())
+    elapsed = time.perf_counter() - started
+
+    results = {
+        'commit' : commit(),
+        'messages' : len(samples),
+        'elapsed' : elapsed,
+        'throughput' : len(samples) / elapsed if elapsed else 0.0,
+        'phases' : {},
+    }
+    for phase in phases:
+        values = sorted(sample[phase] for sample in samples)
+        results['phases'][phase] = {
+            'mean' : sum(values) / len(values) if values else 0.0,
+            'p50' : percentile(values, 50),
+            'p99' : percentile(values, 99),
+        }
+    return results
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except:
+        return None
+
+def report(results):
+    print(f"{results['messages']} messages in {results['elapsed']:.3f}s, {results['throughput']:.0f} messages/s (commit {results['commit']})")
+    print(f"{'phase':>10} {'mean':>10} {'p50':>10} {'p99':>10}  (microseconds)")
+    for phase, stats in results['phases'].items():
+        print(f"{phase:>10} {stats['mean'] * 1e6:10.1f} {stats['p50'] * 1e6:10.1f} {stats['p99'] * 1e6:10.1f}")
+
+def compare(baseline, results, threshold):
+    """
+    Prints the changes from `baseline` and returns the phases whose p99 regressed by more than `threshold` percent.
+    """
+    print(f"\nCompared to commit {baseline['commit']}:")
+    print(f"{'throughput':>10} {baseline['throughput']:.0f} -> {results['throughput']:.0f} messages/s")
+    regressions = []
+    for phase, stats in results['phases'].items():
+        before = baseline['phases'].get(phase)
+        if not before:
+            continue
+        changes = []
+        for key in ('p50', 'p99'):
+            change = (stats[key] / before[key] - 1) * 100 if before[key] else 0.0
+            changes.append(f"{key} {before[key] * 1e6:.1f} -> {stats[key] * 1e6:.1f} ({change:+.0f}%)")
+            if key == 'p99' and change > threshold:
+                regressions.append(phase)
+        print(f"{phase:>10} " + ", ".join(changes))
+    return regressions
+
+def old_loop(receiver, stop):
+    """
+    The sysproxy's main loop before the reactor.
+    """
+    import sysproxy
+    while not stop.is_set():
+        try:
+            sender, batch = channel.receive(receiver, zmq.NOBLOCK)
+        except zmq.Again:
+            ready, _, _ = select.select(list(sysproxy.processes), (), (), 1)
+            for p in ready:
+                p.read()
+                sysproxy.post_output(p)
+            if not ready:
+                time.sleep(0.1)
+            continue
+        for msg in batch:
+            sysproxy.dispatch(receiver, sender, msg, time.time(), 0)
+
+def reactor_loop(receiver, stop):
+    """
+    The sysproxy's main loop, without the parts that aren't involved here.
+    """
+    import sysproxy
+    sysproxy.poller.register(receiver, zmq.POLLIN)
+    try:
+        while not stop.is_set():
+            # Only bounded so that `stop` is noticed.
+            events = dict(sysproxy.poller.poll(min(sysproxy.next_timeout(), 100)))
+            if events.pop(receiver, None):
+                sysproxy.handle_commands(receiver, 0)
+            sysproxy.pump(list(events))
+    finally:
+        sysproxy.poller.unregister(receiver)
+
+def measure_loop(loop, samples):
+    """
+    Runs the sysproxy `loop` on a background thread and returns the latencies of commands and output, in seconds.
+    """
+    import sysproxy
+    posted = {}
+    def respond(msg, text, **kwargs):
+        for line in text.splitlines():
+            posted.setdefault(line.strip(), time.perf_counter())
+    api.slack.respond = respond
+    api.slack.scheduler = None
+    sysproxy.housekeeping_due = float('inf')
+    sysproxy.coalesce.update(quiet=0, max_delay=0)
+
+    context = zmq.Context()
+    address = f"inproc://bench-{loop.__name__}"
+    receiver = context.socket(zmq.ROUTER)
+    receiver.bind(address)
+    client = channel.Client(context, endpoints=[address])
+    stop = threading.Event()
+    thread = threading.Thread(target=loop, args=(receiver, stop), daemon=True)
+    thread.start()
+
+    slack_msg = {'channel' : 'C0BENCH', 'ts' : '1.0', 'user' : 'U0BENCH'}
+    client.request({'command' : 'create', 'thread_id' : '1.0', 'input' : 'cat', 'slack_msg' : slack_msg}, timeout=5)
+    latencies = {'command' : [], 'output' : []}
+    for i in range(samples):
+        # Arrive at a random point of the loop's cycle, as real commands do.
+        time.sleep(random.uniform(0, 0.05))
+        started = time.perf_counter()
+        client.request({'command' : 'ps', 'slack_msg' : slack_msg}, timeout=5)
+        latencies['command'].append(time.perf_counter() - started)
+
+        time.sleep(random.uniform(0, 0.05))
+        line = f"ping {i}"
+        started = time.perf_counter()
+        client.request({'command' : 'write', 'thread_id' : '1.0', 'input' : line + '\n', 'slack_msg' : slack_msg}, timeout=5)
+        while line not in posted and time.perf_counter() - started < 5:
+            time.sleep(0.0005)
+        latencies['output'].append(posted.get(line, float('inf')) - started)
+
+    stop.set()
+    thread.join()
+    for p in list(sysproxy.processes):
+        sysproxy.processes.remove(p.pid)
+        try:
+            sysproxy.poller.unregister(p)
+        except KeyError:
+            pass
+        p.close()
+    receiver.close(linger=0)
+    return latencies
+
+def compare_loops(samples):
+    print(f"{'loop':>8} {'measure':>8} {'mean':>10} {'p50':>10} {'p99':>10}  (milliseconds)")
+    for loop in (old_loop, reactor_loop):
+        for measure, values in measure_loop(loop, samples).items():
+            values.sort()
+            name = loop.__name__[:-len('_loop')]
+            print(f"{name:>8} {measure:>8} {sum(values) / len(values) * 1e3:10.2f} {percentile(values, 50) * 1e3:10.2f} {percentile(values, 99) * 1e3:10.2f}")
+
+# A message event as Slack delivers it, all of which the old channel sent along with every command.
+slack_event = {
+    'client_msg_id' : "8c9b6a34-53a2-4a4d-a2f4-5b1f0f2b2d7e",
+    'type' : 'message',
+    'text' : "> go north",
+    'user' : 'U0BENCH',
+    'ts' : '1546300800.000100',
+    'team' : 'T0BENCH',
+    'blocks' : [{'type' : 'rich_text', 'block_id' : 'Zx1', 'elements' : [{'type' : 'rich_text_section', 'elements' : [{'type' : 'text', 'text' : "> go north"}]}]}],
+    'thread_ts' : '1546300700.000200',
+    'parent_user_id' : 'U0BENCH',
+    'channel' : 'C0BENCH',
+    'event_ts' : '1546300800.000100',
+    'channel_type' : 'channel',
+}
+
+def bench_command(i=0):
+    return {
+        'slack_msg' : slack_event,
+        'thread_id' : slack_event['thread_ts'],
+        'command' : 'write',
+        'input' : f"go north {i}\n",
+    }
+
+def channel_addresses(tmp, name):
+    return {
+        'tcp' : 'tcp://127.0.0.1:*',
+        'ipc' : f"ipc://{os.path.join(tmp, name)}",
+        'inproc' : f"inproc://{name}",
+    }
+
+def bound(socket, address):
+    socket.bind(address)
+    return socket.getsockopt(zmq.LAST_ENDPOINT).decode()
+
+def one_way(context, kind, address, count, send, receive):
+    """
+    Seconds it takes to get `count` commands from one `send`ing socket to a `receive`ing one.
+    """
+    receiver = context.socket(zmq.PULL if kind == 'push' else zmq.ROUTER)
+    sender = context.socket(zmq.PUSH if kind == 'push' else zmq.DEALER)
+    address = bound(receiver, address)
+    sender.connect(address)
+    # Let the connection come up before timing.
+    time.sleep(0.1)
+    done = threading.Event()
+    def drain():
+        for _ in range(count):
+            receive(receiver)
+        done.set()
+    threading.Thread(target=drain, daemon=True).start()
+    started = time.perf_counter()
+    for i in range(count):
+        send(sender, bench_command(i))
+    done.wait()
+    elapsed = time.perf_counter() - started
+    sender.close(linger=0)
+    receiver.close(linger=0)
+    return elapsed
+
+def round_trips(context, address, count, size=1):
+    """
+    The latencies of `count` requests through `channel.Client` to a proxy that only acknowledges them.
+    With a `size` above one, each request is a `request_many` of that many commands.
+    """
+    receiver = context.socket(zmq.ROUTER)
+    address = bound(receiver, address)
+    stop = threading.Event()
+    def proxy():
+        while not stop.is_set():
+            if receiver.poll(100):
+                sender, batch = channel.receive(receiver)
+                for command in batch:
+                    channel.acknowledge(receiver, sender, command)
+    thread = threading.Thread(target=proxy, daemon=True)
+    thread.start()
+    client = channel.Client(context, endpoints=[address])
+    client.request(bench_command(), timeout=5)
+    latencies = []
+    for i in range(count):
+        started = time.perf_counter()
+        if size > 1:
+            client.request_many([bench_command(i * size + j) for j in range(size)], timeout=5)
+        else:
+            client.request(bench_command(i), timeout=5)
+        latencies.append(time.perf_counter() - started)
+    stop.set()
+    thread.join()
+    receiver.close(linger=0)
+    return sorted(latencies)
+
+# How many commands `compare_channels` sends with each `request_many`.
+batch_size = 10
+
+def compare_channels(samples):
+    command = bench_command()
+    encodings = (
+        ('old', lambda: json.dumps(command).encode('utf8')),
+        ('new', lambda: channel.encode(command)),
+    )
+    print(f"{'format':>8} {'bytes':>8} {'encode':>10}  (microseconds)")
+    for name, encode in encodings:
+        started = time.perf_counter()
+        for _ in range(samples):
+            frame = encode()
+        print(f"{name:>8} {len(frame):8d} {(time.perf_counter() - started) / samples * 1e6:10.2f}")
+
+    context = zmq.Context()
+    count = samples * 100
+    tmp = tempfile.mkdtemp(prefix='hmbot-bench-')
+    print(f"\n{'channel':>12} {'commands/s':>12} {'rtt p50':>10} {'rtt p99':>10} {'batched/s':>12}  (microseconds)")
+    elapsed = one_way(context, 'push', 'tcp://127.0.0.1:*', count,
+        lambda socket, command: socket.send_json(command), lambda socket: socket.recv_json())
+    print(f"{'old tcp':>12} {count / elapsed:12.0f} {'-':>10} {'-':>10} {'-':>12}")
+    for transport in ('tcp', 'ipc', 'inproc'):
+        elapsed = one_way(context, 'dealer', channel_addresses(tmp, 'one-way')[transport], count,
+            lambda socket, command: socket.send(channel.encode(command)), lambda socket: channel.receive(socket))
+        latencies = round_trips(context, channel_addresses(tmp, 'round-trip')[transport], samples)
+        batches = round_trips(context, channel_addresses(tmp, 'batched')[transport], samples, batch_size)
+        print(f"{'new ' + transport:>12} {count / elapsed:12.0f} {percentile(latencies, 50) * 1e6:10.1f} {percentile(latencies, 99) * 1e6:10.1f} "
+            f"{samples * batch_size / sum(batches):12.0f}")
+    context.term()
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description="Replays Slack messages through hmbot and times them.")
+    args.add_argument('inputs', nargs='*', help="JSON lines files to replay")
+    args.add_argument('--repeat', type=int, default=20, help="how many times to replay the inputs")
+    args.add_argument('--warmup', type=int, default=1, help="replays to run before measuring")
+    args.add_argument('--output', help="write the results to this file as JSON")
+    args.add_argument('--compare', help="compare with results written by --output")
+    args.add_argument('--threshold', type=float, default=25.0, help="allowed p99 regression in percent")
+    args.add_argument('--log', action='store_true', help="keep hmbot's debug logging on")
+    args.add_argument('--loops', action='store_true', help="compare the sysproxy's reactor with its old loop instead")
+    args.add_argument('--channel', action='store_true', help="measure the endpoint to sysproxy command channel instead")
+    args.add_argument('--samples', type=int, default=50, help="commands to time per loop with --loops, or round trips with --channel")
+    args = args.parse_args()
+
+    if not args.log:
+        logging.disable(logging.INFO)
+
+    if args.loops:
+        compare_loops(args.samples)
+        sys.exit(0)
+    if args.channel:
+        compare_channels(args.samples)
+        sys.exit(0)
+
+    hmbot.db.configure(endpoint.db_path)
+    hmbot.db.setup()
+    timer = Phases()
+    install_fakes(timer)
+
+    events = load_messages(args.inputs)
+    if args.warmup:
+        replay(events, args.warmup, timer)
+    results = replay(events, args.repeat, timer)
+    report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        if regressions:
+            print(f"p99 regressed by more than {args.threshold:.0f}% in: {', '.join(regressions)}")
+            sys.exit(1)
@@ -0,0 +1,174 @@
+"""
+Small in-memory caches.
+"""
+
+import logging, threading, time
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger('cache')
+logger.setLevel(logging.DEBUG)
+
+class TTLSet:
+    """
+    A bounded set whose members expire `ttl` seconds after they were added.
+
+    Every member lives for the same `ttl`, so insertion order is also expiry order and
+    both expiring and evicting the oldest member happen at the front of an `OrderedDict`.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key, seen=None):
+        """
+        Adds `key`, which was seen at time `seen` (defaults to now).
+        Returns `False` if `key` was already a live member.
+
+        When restoring members, add them in the order they were seen.
+        """
+        now = time.time()
+        expires = (now if seen is None else seen) + self.ttl
+        with self._lock:
+            self._expire(now)
+            if key in self._items:
+                return False
+            if expires > now:
+                self._items[key] = expires
+                while len(self._items) > self.maxsize:
+                    self._items.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __contains__(self, key):
+        with self._lock:
+            self._expire(time.time())
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            self._expire(time.time())
+            return len(self._items)
+
+    def _expire(self, now):
+        items = self._items
+        while items:
+            key, expires = next(iter(items.items()))
+            if expires > now:
+                break
+            del items[key]
+
+class LRUCache:
+    """
+    A mapping that holds on to the `maxsize` most recently used keys.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def __len__(self):
+        return len(self._items)
+
+class TTLCache:
+    """
+    Caches the results of a slow `loader` for `ttl` seconds, then serves them stale while refreshing.
+
+    For `stale` seconds after an entry expires, `get` still returns it straight away
+    and reloads it on a background thread.  Older entries are reloaded before returning.
+    Concurrent loads of the same key are collapsed into one.
+    Only results for which `cacheable(result)` is true are kept.
+    """
+
+    def __init__(self, ttl, stale=0, maxsize=128, cacheable=None):
+        self.ttl = ttl
+        self.stale = stale
+        self.cacheable = cacheable or (lambda result: True)
+        self._entries = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self._loading = {}
+
+    def get(self, key, loader):
+        value, state = self.lookup(key)
+        if state == 'fresh':
+            return value
+        if state == 'stale':
+            self._refresh(key, loader)
+            return value
+        return self._load(key, loader)
+
+    def lookup(self, key):
+        """
+        Returns the cached value of `key` and whether it is `'fresh'`, `'stale'` or `'missing'`,
+        for callers that load values themselves, e.g. from a coroutine.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None, 'missing'
+        loaded, value = entry
+        age = time.monotonic() - loaded
+        if age < self.ttl:
+            return value, 'fresh'
+        if age < self.ttl + self.stale:
+            return value, 'stale'
+        return None, 'missing'
+
+    def put(self, key, value, loaded=None):
+        """
+        Caches `value` if it is cacheable.  `loaded` is when loading it started (defaults to now).
+        """
+        if self.cacheable(value):
+            self._entries[key] = (time.monotonic() if loaded is None else loaded, value)
+
+    def _load(self, key, loader):
+        with self._lock:
+            lock = self._loading.get(key)
+            if lock is None:
+                lock = self._loading[key] = threading.Lock()
+        with lock:
+            # Somebody else may have loaded it while we waited.
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            started = time.monotonic()
+            value = loader()
+            self.put(key, value, started)
+            return value
+
+    def _refresh(self, key, loader):
+        with self._lock:
+            lock = self._loading.get(key)
+            if lock is not None and lock.locked():
+                return
+        def refresh():
+            try:
+                self._load(key, loader)
+            except:
+                logger.exception(f"Could not refresh {key}.")
+        threading.Thread(target=refresh, name="cache-refresh", daemon=True).start()
@@ -0,0 +1,210 @@
+"""
+The command channel from the endpoint to the `sysproxy`.
+
+Commands are dicts like the ones built in hmbot.py.  On the wire each command is one ZeroMQ frame of JSON,
+carrying only the parts of the Slack message that the proxy uses.
+Several commands may be sent together as the frames of one multipart message, see `Client.request_many`.
+
+The endpoint connects DEALER sockets to the proxy's ROUTER socket.
+There may be several proxies, or shards, each owning the processes of some threads.
+A command is routed by a stable hash of its `thread_id`, so every command for a thread reaches the same shard.
+The proxy acknowledges every command that has an `id` with a frame like `{"id": ..., "ok": true}`,
+which lets `Client.request` find out quickly that the proxy is down or falling behind.
+Both directions have small high-water marks, so commands can't silently pile up in ZeroMQ's buffers.
+"""
+
+import logging, os, threading, time, itertools, zlib
+import ujson, zmq
+import metrics
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger('channel')
+logger.setLevel(logging.DEBUG)
+
+# Any ZeroMQ endpoint works, e.g. `ipc:///tmp/hmbot-sysproxy`.
+# `inproc://` addresses only work when both ends share a process and a context.
+# Separate the addresses of several shards with commas.
+address = os.environ.get('SYSPROXY_ADDR', 'tcp://127.0.0.1:5557')
+shards = address.split(',')
+
+# How many messages may be queued in either direction, and how long to wait for an acknowledgement.
+high_water_mark = int(os.environ.get('COMMAND_HWM', 100))
+ack_timeout = float(os.environ.get('COMMAND_TIMEOUT', 2.0))
+
+send_seconds = metrics.Histogram('channel_send_seconds', "Time spent handing commands to ZeroMQ, by shard.", labels=('shard',))
+request_seconds = metrics.Histogram('channel_request_seconds', "Time until the proxy acknowledged a command, by shard.", labels=('shard',))
+unavailable = metrics.Counter('channel_unavailable_total', "Commands that couldn't be queued or weren't acknowledged in time.")
+
+class ProxyUnavailable(Exception):
+    """Raised when a command can't be queued, or isn't acknowledged in time."""
+    pass
+
+# The fields of a Slack message that the proxy uses to reply and to keep track of processes,
+# and the message's trace context, see `tracing`.
+slack_fields = ('channel', 'ts', 'thread_ts', 'user', 'trace')
+
+def slim(command):
+    """
+    Returns a copy of `command` whose Slack message only has `slack_fields`.
+    """
+    command = dict(command)
+    msg = command.get('slack_msg')
+    if msg:
+        command['slack_msg'] = {key : msg[key] for key in slack_fields if key in msg}
+    return command
+
+def encode(command):
+    return ujson.dumps(slim(command), ensure_ascii=False).encode('utf8')
+
+def decode(frame):
+    return ujson.loads(frame)
+
+def receive(socket, flags=0):
+    """
+    Receives the next message from a ROUTER `socket`.
+    Returns the identity of the sender and the list of commands in the message.
+    """
+    identity, *frames = socket.recv_multipart(flags)
+    return identity, [decode(frame) for frame in frames]
+
+def shard_for(thread_id, count):
+    """
+    The index of the shard that owns `thread_id`.
+    """
+    if thread_id is None or count == 1:
+        return 0
+    return zlib.crc32(str(thread_id).encode('utf8')) % count
+
+def acknowledge(socket, identity, command, ok=True, error=None, result=None):
+    """
+    Tells the sender of `command` that it has been handled, passing along the fields of `result`.
+    """
+    if 'id' not in command:
+        return
+    ack = dict(result or {}, id=command['id'], ok=ok)
+    if error:
+        ack['error'] = error
+    try:
+        socket.send_multipart([identity, encode(ack)], zmq.NOBLOCK)
+    except zmq.Again:
+        logger.warning(f"Could not acknowledge command {command['id']}.")
+
+def bind(context, shard=0):
+    """
+    Creates the proxy's end of the channel for the `shard`th address.
+    """
+    socket = context.socket(zmq.ROUTER)
+    socket.setsockopt(zmq.SNDHWM, high_water_mark)
+    socket.setsockopt(zmq.RCVHWM, high_water_mark)
+    socket.bind(shards[shard])
+    return socket
+
+class Client:
+    """
+    The endpoint's end of the channel.  It may be used from several threads.
+
+    `request` sends a command on a socket of the calling thread's own
+    and waits for the proxy to acknowledge it.  `broadcast` does the same with every shard.
+    `request_many` sends several commands at once, as one message per shard, and waits for all of them.
+    """
+
+    def __init__(self, context, endpoints=None):
+        self.context = context
+        self.endpoints = endpoints or shards
+        self._ids = itertools.count()
+        self._local = threading.local()
+
+    def _connect(self, endpoint):
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.SNDHWM, high_water_mark)
+        socket.setsockopt(zmq.RCVHWM, high_water_mark)
+        socket.setsockopt(zmq.LINGER, 0)
+        # Don't queue anything for a proxy that isn't connected.
+        socket.setsockopt(zmq.IMMEDIATE, 1)
+        socket.connect(endpoint)
+        return socket
+
+    def _local_socket(self, shard):
+        sockets = getattr(self._local, 'sockets', None)
+        if sockets is None:
+            sockets = self._local.sockets = [None] * len(self.endpoints)
+        if sockets[shard] is None:
+            sockets[shard] = self._connect(self.endpoints[shard])
+        return sockets[shard]
+
+    def shard(self, command):
+        return shard_for(command.get('thread_id'), len(self.endpoints))
+
+    def request(self, command, timeout=None):
+        """
+        Sends `command` to the shard owning its thread and returns the acknowledgement.
+        Raises `ProxyUnavailable` if it can't be sent or isn't acknowledged within `timeout` seconds.
+        """
+        return self._request([(self.shard(command), [command])], timeout)[0]
+
+    def broadcast(self, command, timeout=None):
+        """
+        Sends `command` to every shard and returns their acknowledgements.
+        Raises `ProxyUnavailable` unless every shard acknowledges it within `timeout` seconds.
+        """
+        return self._request([(shard, [command]) for shard in range(len(self.endpoints))], timeout)
+
+    def request_many(self, commands, timeout=None):
+        """
+        Sends `commands` to the shards owning their threads, all of a shard's commands in one message,
+        and returns their acknowledgements in the same order.
+        Only worth it for commands that are ready at the same time, since nothing is held back to fill a batch.
+        Raises `ProxyUnavailable` unless every command is acknowledged within `timeout` seconds.
+        """
+        batches = {}
+        for i, command in enumerate(commands):
+            batches.setdefault(self.shard(command), []).append((i, command))
+        acks = self._request([(shard, [command for _, command in batch]) for shard, batch in batches.items()], timeout)
+        ordered = [None] * len(acks)
+        for (i, _), ack in zip((entry for batch in batches.values() for entry in batch), acks):
+            ordered[i] = ack
+        return ordered
+
+    def _request(self, batches, timeout):
+        """
+        Sends each list of commands in `batches` to its shard as one message.
+        Returns the acknowledgements in the order of the commands.
+        """
+        timeout = ack_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        waiting = []
+        for shard, commands in batches:
+            what = commands[0]['command'] if len(commands) == 1 else f"{len(commands)} commands"
+            socket = self._local_socket(shard)
+            sent = [dict(command, id=next(self._ids)) for command in commands]
+            started = time.perf_counter()
+            try:
+                frames = [encode(command) for command in sent]
+                try:
+                    socket.send_multipart(frames, zmq.NOBLOCK)
+                except zmq.Again:
+                    # A new socket can't queue anything until it has connected, and a full one until the proxy catches up.
+                    if not socket.poll(max(0, deadline - time.monotonic()) * 1000, zmq.POLLOUT):
+                        unavailable.inc(len(frames))
+                        raise ProxyUnavailable(f"Could not queue {what} for shard {shard} within {timeout}s.")
+                    socket.send_multipart(frames, zmq.NOBLOCK)
+            finally:
+                send_seconds.observe(time.perf_counter() - started, (str(shard),))
+            waiting.append((shard, socket, what, [command['id'] for command in sent], started))
+        acks = []
+        for shard, socket, what, ids, started in waiting:
+            pending = {id : None for id in ids}
+            missing = len(ids)
+            while missing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not socket.poll(remaining * 1000):
+                    unavailable.inc(missing)
+                    raise ProxyUnavailable(f"{what} was not acknowledged by shard {shard} within {timeout}s.")
+                ack = decode(socket.recv())
+                # Acknowledgements of requests that timed out earlier may still turn up.
+                if pending.get(ack.get('id'), False) is None:
+                    pending[ack['id']] = ack
+                    missing -= 1
+            request_seconds.observe(time.perf_counter() - started, (str(shard),))
+            acks.extend(pending[id] for id in ids)
+        return acks
@@ -2,13 +2,121 @@
 Some conveniece methods for accessing databases and declaritivly specifying schemata.
 """
 
+import logging, sqlite3, threading, zlib
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger('database')
+logger.setLevel(logging.DEBUG)
+
 class SchemaConflict(Exception):
     pass
 
+class Table:
+    """
+    A table schema with keys and indexes, for when a tuple of columns isn't enough.
+
+    `primary_key` is a tuple of column names.  `unique` and `indexes` are tuples of such tuples.
+    Unique constraints are implemented as unique indexes, so that they can also be added to existing tables.
+    """
+    def __init__(self, columns, primary_key=(), unique=(), indexes=()):
+        self.columns = tuple(columns)
+        self.primary_key = tuple(primary_key)
+        self.unique = tuple(tuple(cols) for cols in unique)
+        self.indexes = tuple(tuple(cols) for cols in indexes)
+
+    def __eq__(self, other):
+        return isinstance(other, Table) and vars(self) == vars(other)
+
+    def create_statement(self, name):
+        cols = [f"{key} {value}" for (key, value) in self.columns]
+        if self.primary_key:
+            cols.append(f"PRIMARY KEY ({', '.join(self.primary_key)})")
+        return f"CREATE TABLE {name} ({', '.join(cols)})"
+
+    def index_definitions(self, name):
+        """
+        Returns `(index name, unique, columns)` for the unique constraints and indexes.
+        """
+        definitions = []
+        for unique, indexes in ((True, self.unique), (False, self.indexes)):
+            for cols in indexes:
+                definitions.append((f"{name}_{'_'.join(cols)}_{'unique' if unique else 'idx'}", unique, cols))
+        return definitions
+
+    def index_statements(self, name):
+        """
+        Returns `(index name, CREATE INDEX statement)` pairs for the unique constraints and indexes.
+        """
+        return [(index, f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {index} ON {name} ({', '.join(cols)})")
+            for (index, unique, cols) in self.index_definitions(name)]
+
+    def __repr__(self):
+        return f"Table({self.columns!r}, primary_key={self.primary_key!r}, unique={self.unique!r}, indexes={self.indexes!r})"
+
 class DatabaseProvider:
+    """
+    Owns the schema declared with `table` and the connections to the database.
+
+    Every thread gets its own connection, opened on first use with the settings given to `configure`.
+    Use `connect` to run statements on it.
+    """
     def __init__(self, name):
         self.name = name
         self.tables = {}
+        self.path = None
+        self.settings = {}
+        self._local = threading.local()
+
+    def configure(self, path, journal_mode='WAL', synchronous='NORMAL', busy_timeout=5000, cached_statements=256):
+        """
+        Sets the database file and the settings for new connections.
+
+        WAL mode lets readers carry on while a transaction commits,
+        and `synchronous='NORMAL'` is still safe with it while fsyncing much less.
+        `busy_timeout` is in milliseconds.  `cached_statements` is the size of each connection's prepared statement cache.
+        """
+        self.path = path
+        self.settings = {
+            'journal_mode' : journal_mode,
+            'synchronous' : synchronous,
+            'busy_timeout' : busy_timeout,
+            'cached_statements' : cached_statements,
+        }
+
+    def connection(self):
+        """
+        Returns the calling thread's connection, opening it if needed.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            settings = self.settings
+            conn = sqlite3.connect(
+                self.path,
+                timeout=settings['busy_timeout'] / 1000,
+                cached_statements=settings['cached_statements'])
+            conn.execute(f"PRAGMA journal_mode={settings['journal_mode']}")
+            conn.execute(f"PRAGMA synchronous={settings['synchronous']}")
+            conn.execute(f"PRAGMA busy_timeout={int(settings['busy_timeout'])}")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def connect(self):
+        """
+        Yields the calling thread's connection, then commits, or rolls back if the block raised.
+
+        Usage:
+        with db.connect() as conn:
+            conn.execute("INSERT INTO foo VALUES (?, ?)", (bar, bin))
+        """
+        conn = self.connection()
+        try:
+            yield conn
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
 
     def table(self, **kwargs):
         """
@@ -18,34 +126,104 @@ class DatabaseProvider:
         @db.table(foo=(("bar", "TEXT"), ("bin", "TEXT")))
         def whatev(db): pass
 
-        This will ensure that the `db` object passed to `whatev` will have a table named `foo` and two `TEXT` columns named `bar` and `bin`.
+        This will ensure that the database of the `db` object passed to `whatev` will have a table named `foo` and two `TEXT` columns named `bar` and `bin`.
+        Pass a `Table` instead of the columns to declare keys and indexes as well.
         """
         def dec(func):
             return func
         for name, columns in kwargs.items():
-            if name in self.tables and columns != self.tables['name']:
+            if not isinstance(columns, Table):
+                columns = Table(columns)
+            if name in self.tables and columns != self.tables[name]:
                 raise SchemaConflict(name)
             else:
                 self.tables[name] = columns
         return dec
 
-    def setup(self, conn):
+    def version(self):
         """
-        Creates tables from `table` decorator invocations.
+        A fingerprint of every declared table, stored as the database's `user_version` once its schema matches.
         """
-        # Get a list of tables.
-        q = conn.execute("SELECT name FROM sqlite_master WHERE type='table'");
-        actual = set(r[0] for r in q.fetchall())
-        expected = set(self.tables.keys())
-        # Get names of tables that have been declared but that do not yet exist.
-        to_create = expected - actual
-        # TODO: Verify existing tables:
-        # to_verify = expected.intersection(actual)
+        declared = repr(sorted(self.tables.items()))
+        return zlib.crc32(declared.encode('utf8')) & 0x7fffffff
 
-        # Create the missing tables.
-        for table in to_create:
-            cols = ', '.join(f"{key} {value}" for (key, value) in self.tables[table])
-            conn.execute(f"CREATE TABLE {table} ({cols})")
-        if to_create:
+    def setup(self, conn=None):
+        """
+        Brings the database up to date with the `table` decorator invocations.
+
+        If the database's `user_version` matches the declared schema there is nothing to do,
+        so a normal startup costs a single query however many tables there are.
+        Otherwise missing tables, columns and indexes are added in one transaction.
+        Changes that can't be made by adding things raise `SchemaConflict` and leave the database untouched.
+        """
+        conn = conn or self.connection()
+        version = self.version()
+        if conn.execute("PRAGMA user_version").fetchone()[0] == version:
+            return
+        logger.info(f"Migrating database schema to version {version}.")
+        complete = True
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Get a list of tables and indexes.
+            q = conn.execute("SELECT type, name FROM sqlite_master WHERE type IN ('table', 'index')")
+            rows = q.fetchall()
+            actual = set(name for (kind, name) in rows if kind == 'table')
+            indexes = set(name for (kind, name) in rows if kind == 'index')
+            for table, schema in self.tables.items():
+                if table not in actual:
+                    logger.info(f"Creating table {table}.")
+                    conn.execute(schema.create_statement(table))
+                else:
+                    self._migrate_columns(conn, table, schema)
+                    self._check_indexes(conn, table, schema, indexes)
+                for index, statement in schema.index_statements(table):
+                    if index in indexes:
+                        continue
+                    logger.info(f"Creating index {index}.")
+                    try:
+                        conn.execute(statement)
+                    except sqlite3.IntegrityError:
+                        # Existing rows break a new unique constraint.  Someone needs to clean them up first.
+                        logger.exception(f"Could not create index {index}.")
+                        complete = False
+            if complete:
+                conn.execute(f"PRAGMA user_version = {version}")
             conn.commit()
+        except:
+            conn.rollback()
+            raise
+
+    def _migrate_columns(self, conn, table, schema):
+        """
+        Adds declared columns that `table` is missing, and complains about ones that differ.
+        """
+        info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        existing = {row[1] : row[2] for row in info}
+        # The `pk` column is the position of a column in the primary key, or 0 for columns that aren't part of it.
+        primary_key = tuple(row[1] for row in sorted((row for row in info if row[5]), key=lambda row: row[5]))
+        if primary_key != schema.primary_key:
+            raise SchemaConflict(f"{table} has the primary key {primary_key}, but {schema.primary_key} is declared.")
+        for column, kind in schema.columns:
+            if column not in existing:
+                logger.info(f"Adding column {table}.{column}.")
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind}")
+            elif existing[column].upper() != kind.upper():
+                raise SchemaConflict(f"{table}.{column} is {existing[column]}, but {kind} is declared.")
+        undeclared = set(existing) - set(column for (column, kind) in schema.columns)
+        if undeclared:
+            logger.warning(f"Table {table} has undeclared columns {sorted(undeclared)}.")
 
+    def _check_indexes(self, conn, table, schema, indexes):
+        """
+        Complains about declared indexes of `table` that exist under their name, but with other columns or uniqueness.
+        """
+        existing = {row[1] : bool(row[2]) for row in conn.execute(f"PRAGMA index_list({table})")}
+        for index, unique, cols in schema.index_definitions(table):
+            if index not in indexes:
+                continue
+            if index not in existing:
+                raise SchemaConflict(f"Index {index} exists, but not on {table}.")
+            actual = tuple(row[2] for row in sorted(conn.execute(f"PRAGMA index_info({index})")))
+            if actual != cols or existing[index] != unique:
+                raise SchemaConflict(f"Index {index} is {'unique ' if existing[index] else ''}on {actual}, "
+                    f"but {'unique ' if unique else ''}{cols} is declared.")
@@ -1,8 +1,9 @@
 """
 Endpoint for calls made from the Slack Events API.
 """
-import json, re, requests, os, sys, logging, bottle, time, sqlite3, zmq
-import hmbot, api.slack, api.meetup
+import json, re, requests, os, sys, logging, bottle, time, zmq
+from concurrent.futures import ThreadPoolExecutor
+import hmbot, database, workers, cache, channel, metrics, tracing, api.slack, api.meetup
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('endpoint')
@@ -12,9 +13,94 @@ db_path            = os.environ['SQLITE_DB']
 api.slack.token    = os.environ['SLACK_TOKEN']
 verification_token = os.environ['VERIFICATION_TOKEN']
 
+# Events are handed to this pool so Slack gets its acknowledgement right away.
+# Slack retries events that aren't acknowledged within 3 seconds.
+# `None` handles events inline.
+pool = None
 queue = None
 
-def handle_post(message):
+# With `SERVER=asyncio` events are handled on an event loop instead, see `run_async`.
+# Actions that aren't declared with `async def` run in this executor.
+server = os.environ.get('SERVER', 'bottle')
+executor = None
+
+# Slack redelivers events it thinks we missed, so remember which ones we have already seen.
+# With `DEDUPE_PERSIST` set they are also written to the database and survive a restart.
+seen_events = cache.TTLSet(
+    maxsize=int(os.environ.get('DEDUPE_SIZE', 10000)),
+    ttl=float(os.environ.get('DEDUPE_TTL', 900)))
+persist_seen_events = bool(os.environ.get('DEDUPE_PERSIST'))
+
+handle_post_seconds = metrics.Histogram('hmbot_handle_post_seconds', "Time spent in `handle_post`, including handling the event when it is handled inline.")
+events_total = metrics.Counter('hmbot_events_total', "Events API callbacks, by what became of them.", labels=('outcome',))
+work_queue_depth = metrics.Gauge('hmbot_work_queue_depth', "Events waiting for, or being handled by, the worker pool.",
+    function=lambda: pool.stats()['depth'] if pool else 0)
+
+class Overloaded(Exception):
+    """Raised when an event can't be queued for handling."""
+    pass
+
+# Runs the database writes of `is_duplicate` and `forget_event` in the asyncio server, so they don't block the event loop.
+# One thread, so that a forgotten event is deleted after it was stored.
+persist_executor = None
+
+def persist(func, *args):
+    if persist_executor is None:
+        func(*args)
+    else:
+        persist_executor.submit(func, *args)
+
+@hmbot.db.table(seen_events=database.Table((("event_id", "TEXT"), ("seen", "REAL")), unique=(("event_id",),), indexes=(("seen",),)))
+def is_duplicate(event_id):
+    """
+    Records `event_id` and returns `True` if it has been seen before.
+    """
+    if not event_id:
+        return False
+    seen = time.time()
+    if not seen_events.add(event_id, seen):
+        return True
+    if persist_seen_events:
+        persist(store_event, event_id, seen)
+    return False
+
+def store_event(event_id, seen):
+    try:
+        with hmbot.db.connect() as conn:
+            conn.execute("DELETE FROM seen_events WHERE seen < ?", (seen - seen_events.ttl,))
+            conn.execute("INSERT OR REPLACE INTO seen_events VALUES (?, ?)", (event_id, seen))
+    except:
+        logger.exception("Could not persist event id.")
+
+def forget_event(event_id):
+    """
+    Undoes `is_duplicate`, so that a redelivery of `event_id` will be handled.
+    """
+    seen_events.discard(event_id)
+    if persist_seen_events:
+        persist(delete_event, event_id)
+
+def delete_event(event_id):
+    try:
+        with hmbot.db.connect() as conn:
+            conn.execute("DELETE FROM seen_events WHERE event_id = ?", (event_id,))
+    except:
+        logger.exception("Could not forget event id.")
+
+def load_seen_events():
+    """
+    Restores the event ids persisted by `is_duplicate` that haven't expired yet.
+    """
+    cutoff = time.time() - seen_events.ttl
+    with hmbot.db.connect() as conn:
+        conn.execute("DELETE FROM seen_events WHERE seen < ?", (cutoff,))
+        rows = conn.execute("SELECT event_id, seen FROM seen_events ORDER BY seen").fetchall()
+    for event_id, seen in rows:
+        seen_events.add(event_id, seen)
+    logger.info(f"Restored {len(seen_events)} seen event ids.")
+
+@handle_post_seconds.time()
+def handle_post(message, retry=None):
     if 'type' not in message:
         logger.info(f"type missing in message {message}")
         return
@@ -28,7 +114,21 @@ def handle_post(message):
     if t == 'url_verification':
         return message['challenge']
     elif t == 'event_callback':
-        return handle_event(message['event'])
+        if is_duplicate(message.get('event_id')):
+            logger.info(f"ignoring duplicate event {message.get('event_id')} (retry {retry})")
+            events_total.inc(labels=('duplicate',))
+            return
+        with tracing.root('handle_post', event_id=message.get('event_id')) as context:
+            if context:
+                message['event']['trace'] = context
+            try:
+                result = handle_event(message['event'])
+            except Overloaded:
+                events_total.inc(labels=('overloaded',))
+                forget_event(message.get('event_id'))
+                raise
+        events_total.inc(labels=('accepted',))
+        return result
     else:
         logger.debug(f"unknown message type {t} in message {message}")
 
@@ -55,7 +155,24 @@ def handle_message(event):
         return
 
     logger.debug(f"received event {event}")
-    return hmbot.handle_message(event, db=conn, queue=queue, api=api)
+    if pool is None:
+        return process_message(event)
+    if not pool.submit(event, queued=time.time()):
+        raise Overloaded()
+
+def process_message(event, queued=None):
+    context = event.get('trace')
+    if queued:
+        tracing.record(context, 'queue_wait', queued)
+    with tracing.span(context, 'handle_message'):
+        return hmbot.handle_message(event, db=hmbot.db, queue=queue, api=api)
+
+async def process_message_async(event, queued=None):
+    context = event.get('trace')
+    if queued:
+        tracing.record(context, 'queue_wait', queued)
+    with tracing.span(context, 'handle_message'):
+        return await hmbot.handle_message_async(event, db=hmbot.db, queue=queue, api=api, executor=executor)
 
 @bottle.post('/')
 @bottle.post('/eb83190ba19fb434e1bc7ed1b0074497df834db1debe093f97b36cd5b3262c31')
@@ -63,19 +180,93 @@ def slack_event_api():
     # bottle is nice and simply but has a horrible design where request and
     # response are global objects.
     try:
-        return handle_post(bottle.request.json) or ''
+        retry = bottle.request.headers.get('X-Slack-Retry-Num')
+        return handle_post(bottle.request.json, retry=retry) or ''
+    except Overloaded:
+        # Let Slack retry the event later.
+        bottle.response.status = 503
+        return ''
     except:
         logger.error("Error in handle_post", exc_info=True)
         return ''
 
+@bottle.get('/stats')
+def stats():
+    return {
+        'workers' : pool.stats() if pool else {},
+        'slack' : api.slack.pool_stats(),
+        'scheduler' : api.slack.scheduler.stats() if api.slack.scheduler else {},
+    }
+
+def run_async(host, port):
+    """
+    Serves the same routes as bottle with aiohttp, handling events as tasks on one event loop.
+    """
+    from aiohttp import web
+
+    async def slack_event_api(request):
+        try:
+            retry = request.headers.get('X-Slack-Retry-Num')
+            return web.Response(text=handle_post(await request.json(), retry=retry) or '')
+        except Overloaded:
+            return web.Response(status=503, text='')
+        except:
+            logger.error("Error in handle_post", exc_info=True)
+            return web.Response(text='')
+
+    async def stats_api(request):
+        return web.json_response(stats())
+
+    async def metrics_api(request):
+        return web.Response(body=metrics.render().encode('utf8'), headers={'Content-Type' : metrics.content_type})
+
+    async def close_session(app):
+        await api.slack.close_async_session()
+        await api.meetup.close_async_session()
+
+    app = web.Application()
+    app.router.add_post('/', slack_event_api)
+    app.router.add_post('/eb83190ba19fb434e1bc7ed1b0074497df834db1debe093f97b36cd5b3262c31', slack_event_api)
+    app.router.add_get('/stats', stats_api)
+    app.router.add_get('/metrics', metrics_api)
+    app.on_cleanup.append(close_session)
+    web.run_app(app, host=host, port=port)
+
+@bottle.get('/metrics')
+def metrics_api():
+    bottle.response.content_type = metrics.content_type
+    return metrics.render()
+
 # Auto reloading doesn't work that well because it crashes if you have a typo.
 if __name__ == '__main__':
-    conn = sqlite3.connect(db_path)
-    hmbot.db.setup(conn)
+    hmbot.db.configure(
+        db_path,
+        synchronous=os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        busy_timeout=int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)))
+    hmbot.db.setup()
+    if persist_seen_events:
+        load_seen_events()
+
+    api.slack.configure(
+        size=int(os.environ.get('SLACK_POOL_SIZE', api.slack.pool_size)),
+        connect_timeout=float(os.environ.get('SLACK_CONNECT_TIMEOUT', api.slack.timeout[0])),
+        read_timeout=float(os.environ.get('SLACK_READ_TIMEOUT', api.slack.timeout[1])))
 
     context = zmq.Context()
-    queue = context.socket(zmq.PUSH)
-    queue.bind("tcp://127.0.0.1:5557")
+    queue = channel.Client(context)
 
-    bottle.run(host='0.0.0.0', port=8080)
+    api.slack.scheduler = api.slack.Scheduler().start()
+    if server == 'asyncio':
+        executor = ThreadPoolExecutor(int(os.environ.get('WORKERS', 4)))
+        persist_executor = ThreadPoolExecutor(1)
+        pool = workers.AsyncWorkerPool(
+            process_message_async,
+            maxsize=int(os.environ.get('WORK_QUEUE_SIZE', 100))).start()
+        run_async(host='0.0.0.0', port=8080)
+    else:
+        pool = workers.WorkerPool(
+            process_message,
+            workers=int(os.environ.get('WORKERS', 4)),
+            maxsize=int(os.environ.get('WORK_QUEUE_SIZE', 100))).start()
+        bottle.run(host='0.0.0.0', port=8080)
 
@@ -1,17 +1,19 @@
 """
 All hmbot functions and state.
 """
-import logging, random, requests, subprocess, fcntl, os, pty, time
+import logging, random, requests, subprocess, fcntl, os, pty, time, datetime
 
-import database
+import database, tracing
+from cache import LRUCache
 from parser import oneof, maybe, Parser, NotHandled
+from channel import ProxyUnavailable
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('hmbot')
 logger.setLevel(logging.DEBUG)
 
 db = database.DatabaseProvider('hmbot')
-parser = Parser(ignore=(',', "'"), remove=("'",))
+parser = Parser(ignore=(',', "'"), remove=("'",), compiled=True)
 
 greetings = oneof('hello', 'hi', 'greetings', 'howdy', '你好', 'goddag', 'hej', 'hejsa', 'hey', 'sup', 'yo')
 verbose_request = oneof('will you please', 'can you please', 'will you', 'can you', 'please')
@@ -32,9 +34,68 @@ class Help:
 
 helper = Help()
 
+# Recent answers of `choose`, so that repeated questions don't have to go to the database.
+recent_choices = LRUCache(int(os.environ.get('CHOICE_CACHE_SIZE', 1024)))
+
+def request(queue, api, msg, command, thread_ts=None, broadcast=False):
+    """
+    Sends `command` to the sysproxy shard owning its thread, or to every shard if `broadcast` is set,
+    and returns their acknowledgements.
+    Returns `None`, after telling the user, if a proxy is overloaded or down.
+    """
+    context = msg.get('trace')
+    if context:
+        # Lets the proxy tell how long the command took to reach it.
+        command = dict(command, sent=time.time())
+    try:
+        with tracing.span(context, 'proxy_request', command=command['command']):
+            if broadcast:
+                return queue.broadcast(command)
+            return [queue.request(command)]
+    except ProxyUnavailable as ex:
+        logger.error(f"sysproxy unavailable: {ex}")
+        api.slack.respond(msg, "Sorry, my process proxy is overloaded right now.  Try again in a bit!", thread_ts=thread_ts)
+        return None
+
+def processes_to_attachments(processes, api):
+    attachments = []
+    for p in processes:
+        attachments.append({
+            "fallback" : "process",
+            "pretext" : p['command'],
+            "fields" : [
+                {
+                    "title" : "Created",
+                    "value" : api.slack.datetime_to_slacktime(datetime.datetime.fromtimestamp(p['created'])),
+                    "short" : True
+                },
+                {
+                    "title" : "Creator",
+                    "value" : "@" + p['created_by'],
+                    "short" : True
+                },
+                {
+                    "title" : "Last Active",
+                    "value" : api.slack.datetime_to_slacktime(datetime.datetime.fromtimestamp(p['last_active'])),
+                    "short" : True
+                },
+                {
+                    "title" : "PID",
+                    "value" : p['pid'],
+                    "short" : True
+                },
+                {
+                    "title" : "Reads / Posts",
+                    "value" : f"{p['reads']} / {p['posts']}",
+                    "short" : True
+                }
+            ]
+        })
+    return attachments
+
 @helper.usage("hmbot, help!", command_type=Help.util)
 @parser.action(maybe(greetings), "hmbot", maybe(verbose_request), oneof("help me", "help", "--help"))
-def help_me(tokens, msg, api=None, **kwargs):
+async def help_me(tokens, msg, api=None, **kwargs):
     """Displays this very message."""
 
     attachments = []
@@ -45,20 +106,20 @@ def help_me(tokens, msg, api=None, **kwargs):
             "color" : color,
             "mrkdwn_in": ["text", "pretext", "title"]
         })
-    api.slack.respond(msg, "Okay, here are some of the things I can do:", attachments=attachments, thread_ts=msg.get('thread_ts'))
+    await api.slack.respond_async(msg, "Okay, here are some of the things I can do:", attachments=attachments, thread_ts=msg.get('thread_ts'))
 
 @parser.action(">")
 @parser.action("&", "gt", ";")
-def process_write(tokens, msg, queue=None, **kwargs):
+def process_write(tokens, msg, queue=None, api=None, **kwargs):
     """Request that the text of this message be sent to the process associated with this thread."""
 
     args = ' '.join(tokens).strip() + '\n'
-    queue.send_json({
+    request(queue, api, msg, {
         'slack_msg' : msg,
         'thread_id' : msg['thread_ts'],
         'command' : 'write',
         'input' : args
-    })
+    }, thread_ts=msg['thread_ts'])
 
 @helper.usage("# ps", command_type=Help.admin)
 @parser.action("# ps")
@@ -66,11 +127,18 @@ def ps(tokens, msg, queue=None, api=None, **kwargs):
     """List all active processes"""
 
     logger.debug("Queueing request.")
-    queue.send_json({
+    acks = request(queue, api, msg, {
         'slack_msg' : msg,
         'thread_id' : msg.get('thread_ts'),
         'command' : 'ps'
-    })
+    }, thread_ts=msg.get('thread_ts'), broadcast=True)
+    if acks is None:
+        return
+    processes = sorted((p for ack in acks for p in ack.get('processes', ())), key=lambda p: p['created'])
+    api.slack.respond(
+        msg, "There are %d active processes." % len(processes),
+        attachments=processes_to_attachments(processes, api),
+        thread_ts=msg.get('thread_ts'))
 
 @helper.usage("# kill <pid>", command_type=Help.admin)
 @parser.action("# kill")
@@ -82,12 +150,18 @@ def kill(tokens, msg, queue=None, api=None, **kwargs):
         return
 
     logger.debug("Queueing request.")
-    queue.send_json({
+    acks = request(queue, api, msg, {
         'slack_msg' : msg,
         'thread_id' : msg.get('thread_ts'),
         'command' : 'kill',
         'pid' : int(tokens[0])
-    })
+    }, thread_ts=msg.get('thread_ts'), broadcast=True)
+    if acks is None:
+        return
+    if any(ack.get('killed') for ack in acks):
+        api.slack.respond(msg, ":skull:")
+    else:
+        api.slack.respond(msg, "No such process.")
 
 @helper.usage("Yo hmbot, let's play <game>!", command_type=Help.fun)
 @parser.action(maybe(greetings), "hmbot", maybe("lets"), "play")
@@ -99,16 +173,46 @@ def games(tokens, msg, queue=None, api=None, **kwargs):
         return False
 
     logger.debug("Queueing request to spawn adventure subprocess.")
-    queue.send_json({
+    acks = request(queue, api, msg, {
         'slack_msg' : msg,
         'thread_id' : msg['ts'],
         'command' : 'create',
         'width' : 55,
         'input' : '/usr/games/adventure'
     })
+    if acks is None:
+        return False
+    if not acks[0].get('created'):
+        # The proxy has told the thread why not.
+        return False
     api.slack.respond(msg, "Okay!  Let's play.  Send me game commands by starting your message with '>'", thread_ts=msg['ts'])
 
-@db.table(choose=(("choices", "TEXT"), ("choice", "TEXT")))
+@helper.usage("# scrollback", command_type=Help.util)
+@parser.action("# scrollback")
+def scrollback(tokens, msg, queue=None, api=None, **kwargs):
+    """Repost the recent output of the game in this thread."""
+
+    if 'thread_ts' not in msg:
+        api.slack.respond(msg, "Ask me in the thread of a game!")
+        return
+
+    acks = request(queue, api, msg, {
+        'slack_msg' : msg,
+        'thread_id' : msg['thread_ts'],
+        'command' : 'scrollback',
+        'limit' : 3900
+    }, thread_ts=msg['thread_ts'])
+    if acks is None:
+        return
+    text = acks[0].get('scrollback')
+    if text is None:
+        api.slack.respond(msg, "There's no game in this thread.", thread_ts=msg['thread_ts'])
+    elif not text:
+        api.slack.respond(msg, "Nothing has happened yet.", thread_ts=msg['thread_ts'])
+    else:
+        api.slack.respond(msg, f"```{text}```", thread_ts=msg['thread_ts'])
+
+@db.table(choose=database.Table((("choices", "TEXT"), ("choice", "TEXT")), unique=(("choices",),)))
 @helper.usage("Yo hmbot, (re)choose: <a>, <b>, ...", command_type=Help.fun)
 @parser.action(maybe(greetings), "hmbot", maybe(verbose_request), oneof("rechoose between", "rechoose from", "rechoose", "choose between", "choose from", "choose"), maybe(":"))
 def choose(tokens, msg, db=None, api=None, **kwargs):
@@ -126,52 +230,60 @@ def choose(tokens, msg, db=None, api=None, **kwargs):
     else:
         choice = "FAIL!"
     try:
-        if 'rechoose' in msg['text'][:-(len(tokens) - 1)]:
-            logger.debug(f'rechoosing: "{choice}" from "{choices}".')
-            db.execute(f"DELETE FROM choose WHERE choices = ?", (tokens,))
-            db.execute(f"INSERT INTO choose VALUES (?, ?)", (tokens, choice))
-        else:
-            logger.debug('fetching choice from database.')
-            q = db.execute(f"SELECT choice FROM choose WHERE choices = ?", (tokens,))
-            cache = q.fetchone()
-            if cache:
-                choice = cache[0]
+        with db.connect() as conn:
+            if 'rechoose' in msg['text'][:-(len(tokens) - 1)]:
+                logger.debug(f'rechoosing: "{choice}" from "{choices}".')
+                conn.execute(f"INSERT OR REPLACE INTO choose VALUES (?, ?)", (tokens, choice))
             else:
-                logger.debug(f'inserting {choice} into database.')
-                db.execute(f"INSERT INTO choose VALUES (?, ?)", (tokens, choice))
-        db.commit()
+                cached = recent_choices.get(tokens)
+                if cached is None:
+                    logger.debug('fetching choice from database.')
+                    q = conn.execute(f"SELECT choice FROM choose WHERE choices = ?", (tokens,))
+                    cached = q.fetchone()
+                    cached = cached[0] if cached else None
+                if cached is not None:
+                    choice = cached
+                else:
+                    logger.debug(f'inserting {choice} into database.')
+                    changes = conn.total_changes
+                    conn.execute(f"INSERT OR IGNORE INTO choose VALUES (?, ?)", (tokens, choice))
+                    if conn.total_changes == changes:
+                        # Another worker chose first, so its choice is the one that was kept.
+                        q = conn.execute(f"SELECT choice FROM choose WHERE choices = ?", (tokens,))
+                        choice = q.fetchone()[0]
+        recent_choices[tokens] = choice
     except:
         logger.exception("Database error.")
     api.slack.respond(msg, choice)
 
 @parser.action(maybe(greetings), "hmbot", "i hate you")
-def i_hate_you(tokens, msg, api=None, **kwargs):
-    api.slack.respond(msg, ":broken_heart:")
+async def i_hate_you(tokens, msg, api=None, **kwargs):
+    await api.slack.respond_async(msg, ":broken_heart:")
 
 @helper.usage("Yo hmbot, I love you.", command_type=Help.fun) 
 @parser.action(maybe(greetings), "hmbot", oneof("i love you", "i am in love with you"))
-def i_love_you(tokens, msg, api=None, **kwargs):
+async def i_love_you(tokens, msg, api=None, **kwargs):
     """Feel free to express your undying love for Hmbot."""
-    api.slack.respond(msg, ":heart:")
+    await api.slack.respond_async(msg, ":heart:")
 
 @helper.usage("Yo hmbot, what are the happs?", command_type=Help.util)
 @parser.action(maybe(greetings), "hmbot", oneof("whats happening", "what are the haps", "what are the happs"), "?")
-def what_are_the_haps(text, msg, api=None, **kwargs):
+async def what_are_the_haps(text, msg, api=None, **kwargs):
     """Get a list of upcoming events from the hackmanhattan meetup."""
 
-    okay, value = api.meetup.events('hackmanhattan', 5)
+    okay, value = await api.meetup.events_async('hackmanhattan', 5)
     if okay:
-        api.slack.respond(msg, "Here are some upcoming events:", attachments=value)
+        await api.slack.respond_async(msg, "Here are some upcoming events:", attachments=value)
     else:
-        api.slack.respond(msg, f'Sorry, I dunno.  I get a `{value}` when I try to talk to meetup.')
+        await api.slack.respond_async(msg, f'Sorry, I dunno.  I get a `{value}` when I try to talk to meetup.')
 
 @parser.action(maybe(greetings), oneof("I am", "Im"), "hmbot")
-def no_im_hmbot(text, msg, api=None, **kwargs):
-    api.slack.respond(msg, 'Liar!')
+async def no_im_hmbot(text, msg, api=None, **kwargs):
+    await api.slack.respond_async(msg, 'Liar!')
 
 @parser.action(greetings, "hmbot")
-def hello(text, msg, api=None, **kwargs):
-    api.slack.respond(msg, 'Hello, I am hmbot!')
+async def hello(text, msg, api=None, **kwargs):
+    await api.slack.respond_async(msg, 'Hello, I am hmbot!')
 
 def handle_message(msg, **kwargs):
     logger.debug(f"Received message {msg}.")
@@ -180,7 +292,23 @@ def handle_message(msg, **kwargs):
         try:
             return parser.parse(msg['text'], msg, **kwargs)
         except NotHandled as ex:
-            logger.debug(f"unhandled message '{msg}', with tokens '{ex.tokens}'")
+            if ex.tokens is None:
+                logger.debug(f"unhandled message '{msg}', rejected before tokenizing {parser.filter_stats}")
+            else:
+                logger.debug(f"unhandled message '{msg}', with tokens '{ex.tokens}'")
             return
     logger.debug(f"No message text in {msg}.")
 
+async def handle_message_async(msg, **kwargs):
+    """
+    Like `handle_message`, for the asyncio server.  Blocking actions are run in `executor`.
+    """
+    logger.debug(f"Received message {msg}.")
+
+    if 'text' in msg:
+        try:
+            return await parser.parse_async(msg['text'], msg, **kwargs)
+        except NotHandled as ex:
+            logger.debug(f"unhandled message '{msg}', with tokens '{ex.tokens}'")
+            return
+    logger.debug(f"No message text in {msg}.")
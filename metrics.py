@@ -0,0 +1,199 @@
+"""
+Counters, gauges and histograms, rendered in the Prometheus text format.
+
+Metrics register themselves in `registry` when they are created, at import time,
+and `render` writes all of them out.  Updating one takes a lock and a dict lookup,
+so they are cheap enough for the hot path; labelled children can be bound once with `labels`.
+
+    handled = Counter('hmbot_handled_total', "Messages handled.", labels=('handler',))
+    handled.labels('ps').inc()
+
+`serve` exposes `render` on its own HTTP server, for processes that don't already have one.
+"""
+
+import logging, threading, time, bisect
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger('metrics')
+logger.setLevel(logging.DEBUG)
+
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+registry = []
+
+# Tuned for things that take between a few microseconds and several seconds.
+default_buckets = (.00001, .00005, .0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, 10)
+
+class Bound:
+    """
+    A metric with its label values filled in.
+    """
+
+    def __init__(self, metric, values):
+        self.metric = metric
+        self.values = values
+
+    def inc(self, amount=1):
+        self.metric.inc(amount, self.values)
+
+    def set(self, value):
+        self.metric.set(value, self.values)
+
+    def observe(self, value):
+        self.metric.observe(value, self.values)
+
+    def time(self):
+        return self.metric.time(self.values)
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}.")
+        return Bound(self, tuple(str(value) for value in values))
+
+    def samples(self):
+        """
+        Yields `(suffix, labels, value)` for every sample of this metric.
+        """
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield '', dict(zip(self.labelnames, labels)), value
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    """
+    A value that goes up and down.  With a `function` the value is read when rendering instead of set;
+    for a labelled gauge it returns a dict from label values to values.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+        try:
+            values = self.function()
+        except:
+            logger.exception(f"Could not read {self.name}.")
+            return
+        if not self.labelnames:
+            values = {() : values}
+        for labels, value in values.items():
+            yield '', dict(zip(self.labelnames, labels)), value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, labels=()):
+        """
+        Observes how long the `with` block, or the decorated function, takes.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items()]
+        for labels, (counts, total, count) in values:
+            labels = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                yield '_bucket', dict(labels, le=format_value(bound)), cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, count
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+def render():
+    """
+    All metrics in `registry`, in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for suffix, labels, value in metric.samples():
+            lines.append(f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+def serve(port, host=''):
+    """
+    Serves `/metrics` on a background thread.
+    """
+    server = HTTPServer((host, port), _Handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    logger.info(f"Serving metrics on port {port}.")
+    return server
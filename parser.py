@@ -2,50 +2,165 @@
 Does some really simple parsing of slack messages to determine what actions hmbot should take.
 """
 
-import logging
+import logging, itertools, os, asyncio, functools, threading
 from contextlib import contextmanager
-import spacy
+import tokenizers, metrics
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('hmbot.parser')
 logger.setLevel(logging.DEBUG)
 
-nlp = spacy.load('en')
+# Used for rule literals and, unless a parser is given its own, for messages.
+# Set `HMBOT_TOKENIZER=spacy` to tokenize with spaCy instead.
+default_tokenizer = tokenizers.from_name(os.environ.get('HMBOT_TOKENIZER', 'rule'))
+
+tokenize_seconds = metrics.Histogram('hmbot_tokenize_seconds', "Time spent tokenizing messages.")
+match_seconds = metrics.Histogram('hmbot_match_seconds', "Time spent matching a message against an action's rules.", labels=('handler',))
+handled = metrics.Counter('hmbot_handled_total', "Messages handled, by action.", labels=('handler',))
+not_handled = metrics.Counter('hmbot_not_handled_total', "Messages no action handled, by whether they were `filtered` before tokenizing or `unmatched`.", labels=('reason',))
+filtered, unmatched = not_handled.labels('filtered'), not_handled.labels('unmatched')
+
+# The event loop each thread runs `async def` actions on when they are called from `parse`.
+_loops = threading.local()
+
+def run_sync(coroutine):
+    """
+    Runs `coroutine` to completion on this thread's own event loop and returns its result.
+    The loop is kept, so clients bound to it, like aiohttp sessions, can be reused by later calls.
+    """
+    loop = getattr(_loops, 'loop', None)
+    if loop is None:
+        loop = _loops.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coroutine)
 
 class BackTrack(Exception):
     """Used to drive the backtracking logic."""
     pass
 
 class NotHandled(Exception):
-    """Raised when no action or command corresponds to an input."""
+    """
+    Raised when no action or command corresponds to an input.
+    `tokens` is `None` if the input was rejected before it was tokenized.
+    """
     def __init__(self, tokens):
         self.tokens = tokens
 
 class Parser:
-    def __init__(self, ignore=None, remove=None):
+    """
+    Dispatches token streams to actions.
+
+    With `compiled=True` the literal prefixes of all rules are merged into a single token trie,
+    so a message only has to be walked once to find the handlers that could possibly match it.
+    Those candidates are then run in declaration order, exactly as in the uncompiled mode.
+
+    Before tokenizing, the raw text is checked against the literal tokens that every rule requires.
+    A message containing none of the required combinations can't match and is rejected straight away.
+    `filter_stats` counts how many messages were `rejected` that way and how many `passed`.
+    """
+    def __init__(self, ignore=None, remove=None, compiled=False, tokenizer=None):
         self.remove = tuple(str(e).lower() for e in remove) or ()
         self.ignore = tuple(str(e).lower() for e in ignore) or ()
+        self.tokenize = tokenizer or default_tokenizer
         self.handlers = []
+        self.compiled = compiled
+        self.filter_stats = {'rejected' : 0, 'passed' : 0}
+        # Messages are parsed on several worker threads at once.
+        self._stats_lock = threading.Lock()
+        self._trie = None
+        self._filter = None
 
     def action(self, *args):
-        args = tuple(match(arg) if type(arg) == str else arg for arg in args)
+        args = tuple(match(arg, self.tokenize) if type(arg) == str else arg for arg in args)
         def dec(func):
             self.handlers.append(make_handler(args, func, self.ignore, self.remove))
+            self._trie = None
+            self._filter = None
             return func
         return dec
 
+    def candidates(self, tokens):
+        """
+        Returns the handlers that may match `tokens`, in declaration order.
+        """
+        if not self.compiled:
+            return self.handlers
+        if self._trie is None:
+            self._trie = Trie(self.handlers)
+        indices = self._trie.lookup(normalize(tokens, self.ignore, self.remove))
+        return [self.handlers[i] for i in indices]
+
+    def may_match(self, text):
+        """
+        Cheap necessary condition for `text` to match any rule: some handler must find
+        all of its required literal tokens somewhere in the text.
+        """
+        if self._filter is None:
+            self._filter = required_tokens(self.handlers, self.remove)
+        if not self._filter:
+            return True
+        text = text.lower()
+        for s in self.remove:
+            text = text.replace(s, '')
+        return any(all(token in text for token in required) for required in self._filter)
+
+    def tokens(self, text):
+        """
+        Tokenizes `text`, or raises `NotHandled` if it can't match any rule.
+        """
+        if not self.may_match(text):
+            with self._stats_lock:
+                self.filter_stats['rejected'] += 1
+            filtered.inc()
+            raise NotHandled(None)
+        with self._stats_lock:
+            self.filter_stats['passed'] += 1
+        with tokenize_seconds.time():
+            return self.tokenize(text)
+
     def parse(self, text, *args, **kwargs):
-        tokens = [str(token).lower() for token in nlp(text)]
-        for handler in self.handlers:
+        """
+        Calls the first action matching `text` and returns its result.
+        Actions declared with `async def` are run to completion with `run_sync`.
+        """
+        tokens = self.tokens(text)
+        for handler in self.candidates(tokens):
             try:
                 okay, value = handler(tokens, *args, **kwargs)
                 if okay:
+                    if asyncio.iscoroutine(value):
+                        value = run_sync(value)
+                    handler.handled.inc()
                     return value
             except StopIteration:
                 pass
             except Exception as ex:
                 logger.exception(ex)
                 pass
+        unmatched.inc()
+        raise NotHandled(tokens)
+
+    async def parse_async(self, text, *args, executor=None, **kwargs):
+        """
+        Like `parse`, but awaits actions declared with `async def`.
+        Other actions are run in `executor` (defaults to the loop's), so they can't block the event loop.
+        """
+        tokens = self.tokens(text)
+        loop = asyncio.get_event_loop()
+        for handler in self.candidates(tokens):
+            try:
+                okay, rest = handler.match(tokens)
+                if not okay:
+                    continue
+                handler.handled.inc()
+                if asyncio.iscoroutinefunction(handler.func):
+                    return await handler.func(rest, *args, **kwargs)
+                return await loop.run_in_executor(executor, functools.partial(handler.func, rest, *args, **kwargs))
+            except StopIteration:
+                pass
+            except Exception as ex:
+                logger.exception(ex)
+                pass
+        unmatched.inc()
         raise NotHandled(tokens)
 
 class Stream:
@@ -75,15 +190,120 @@ class Stream:
     def __str__(self):
         return f"Stream(offset={self.offset}, tokens={self.tokens}, ignore={self.ignore})"
 
+def normalize(tokens, ignore, remove):
+    """
+    Applies the same skipping and stripping as `Stream.__next__` to a whole list of tokens.
+    """
+    out = []
+    for token in tokens:
+        if token in ignore:
+            continue
+        for s in remove:
+            token = token.replace(s, '')
+        out.append(token)
+    return out
+
+class Trie:
+    """
+    Merges the literal token sequences of many handlers into one prefix tree.
+
+    Every rule built from `match`, `oneof` and `maybe` only accepts a finite set of token sequences,
+    which are stored on the rule as `sequences`.  A handler whose rules are all like that is inserted
+    once per sequence it accepts.  Handlers using any other kind of rule can't be indexed and are
+    always returned as candidates.
+    """
+
+    # Give up on indexing a handler rather than expanding an absurd number of sequences.
+    limit = 10000
+
+    def __init__(self, handlers):
+        self.root = {}
+        self.always = set()
+        for index, handler in enumerate(handlers):
+            sequences = handler_sequences(handler.rules, self.limit)
+            if sequences is None:
+                self.always.add(index)
+                continue
+            for sequence in sequences:
+                node = self.root
+                for token in sequence:
+                    node = node.setdefault(token, {})
+                node.setdefault(None, set()).add(index)
+
+    def lookup(self, tokens):
+        found = set(self.always)
+        node = self.root
+        found.update(node.get(None, ()))
+        for token in tokens:
+            node = node.get(token)
+            if node is None:
+                break
+            found.update(node.get(None, ()))
+        return sorted(found)
+
+def handler_sequences(rules, limit):
+    """
+    Returns every token sequence accepted by `rules` in order, or `None` if that can't be known.
+    """
+    parts = []
+    total = 1
+    for rule in rules:
+        sequences = getattr(rule, 'sequences', None)
+        if sequences is None:
+            return None
+        total *= len(sequences)
+        if total > limit:
+            return None
+        parts.append(sequences)
+    return set(sum(combo, ()) for combo in itertools.product(*parts))
+
+def required_tokens(handlers, remove):
+    """
+    Returns, for each handler, the literal tokens that appear in every sequence it accepts.
+
+    Returns an empty tuple, meaning nothing can be filtered, if any handler could match without a literal,
+    or if removing multi-character strings could make a token appear that isn't in the raw text.
+    """
+    if any(len(s) != 1 for s in remove):
+        return ()
+    filters = []
+    for handler in handlers:
+        sequences = handler_sequences(handler.rules, Trie.limit)
+        if not sequences:
+            return ()
+        required = frozenset.intersection(*(frozenset(sequence) for sequence in sequences)) - {''}
+        if not required:
+            return ()
+        filters.append(required)
+    # A handler requiring a superset of another handler's tokens adds nothing to the check.
+    return tuple(set(f for f in filters if not any(other < f for other in filters)))
+
+def rule_literals(handlers):
+    """
+    Every string the rules of `handlers` were built from, so the tokenizers can be checked against each other.
+    """
+    return set(literal for handler in handlers for rule in handler.rules for literal in getattr(rule, 'literals', ()))
+
 def make_handler(rules, func, ignore, remove):
-    def handler(tokens, *args, **kwargs):
+    timer = match_seconds.labels(func.__name__)
+    def match(tokens):
         logger.debug(f"Testing '{func.__name__}'")
-        stream = Stream(tokens, ignore, remove)
-        for rule in rules:
-            ret = rule(stream)
-            if not ret:
-                return False, None
-        return True, func(stream.rest(), *args, **kwargs)
+        with timer.time():
+            stream = Stream(tokens, ignore, remove)
+            for rule in rules:
+                ret = rule(stream)
+                if not ret:
+                    return False, None
+            return True, stream.rest()
+    def handler(tokens, *args, **kwargs):
+        okay, rest = match(tokens)
+        if not okay:
+            return False, None
+        return True, func(rest, *args, **kwargs)
+    handler.rules = rules
+    handler.func = func
+    handler.match = match
+    handler.handled = handled.labels(func.__name__)
     return handler
 
 @contextmanager
@@ -94,14 +314,14 @@ def branch(stream):
     except BackTrack:
         stream.offset = offset
 
-def match(string):
+def match(string, tokenize=None):
     """
     Implements `Adapter` pattern for strings to actions.
 
     This is used internally to allow code to act uniformly on inputs.
     You don't need to use this from the hmbot library.
     """
-    rule = [str(token).lower() for token in nlp(string)]
+    rule = (tokenize or default_tokenizer)(string)
     def action(stream):
         for part in rule:
             token = next(stream)
@@ -109,6 +329,8 @@ def match(string):
             if token != part:
                 return False
         return True
+    action.sequences = (tuple(rule),)
+    action.literals = (string,)
     return action
 
 def oneof(*options):
@@ -120,6 +342,9 @@ def oneof(*options):
                     return True
                 stream.abort()
         return False
+    if all(hasattr(opt, 'sequences') for opt in options):
+        action.sequences = tuple(seq for opt in options for seq in opt.sequences)
+    action.literals = tuple(literal for opt in options for literal in getattr(opt, 'literals', ()))
     return action
 
 def maybe(rule):
@@ -131,5 +356,8 @@ def maybe(rule):
             if not rule(stream):
                 stream.abort()
         return True
+    if hasattr(rule, 'sequences'):
+        action.sequences = ((),) + tuple(rule.sequences)
+    action.literals = getattr(rule, 'literals', ())
     return action
 
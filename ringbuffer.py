@@ -0,0 +1,85 @@
+"""
+A fixed-size FIFO of bytes, for holding process output without allocating on every read.
+"""
+
+import os
+
+class RingBuffer:
+    """
+    Holds up to `capacity` bytes in one preallocated `bytearray`.
+
+    `read_from` reads from a file descriptor straight into the free space with `os.readv`,
+    which covers the space after the end of the data and the space before its start with one call.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def free(self):
+        return self.capacity - self._size
+
+    def _free_slices(self):
+        end = (self._start + self._size) % self.capacity
+        if end < self._start:
+            return [self._view[end:self._start]]
+        return [s for s in (self._view[end:], self._view[:self._start]) if len(s)]
+
+    def read_from(self, fd):
+        """
+        Reads as much of what is available from `fd` as fits.
+        Returns the number of bytes read, which is 0 if the buffer is full or `fd` is at its end.
+        Raises `BlockingIOError` if a non-blocking `fd` has nothing to read.
+        """
+        if not self.free:
+            return 0
+        n = os.readv(fd, self._free_slices())
+        self._size += n
+        return n
+
+    def discard(self, n):
+        """
+        Drops the oldest `n` bytes, or all of them if there are fewer.  Returns how many were dropped.
+        """
+        n = min(n, self._size)
+        self._start = (self._start + n) % self.capacity
+        self._size -= n
+        if not self._size:
+            self._start = 0
+        return n
+
+    def extend(self, data):
+        """
+        Appends as much of `data` as fits.  Returns the number of bytes appended.
+        """
+        n = 0
+        for s in self._free_slices():
+            chunk = data[n:n + len(s)]
+            s[:len(chunk)] = chunk
+            n += len(chunk)
+        self._size += n
+        return n
+
+    def peek(self):
+        """
+        Returns everything in the buffer, without removing it.
+        """
+        end = self._start + self._size
+        if end <= self.capacity:
+            return bytes(self._view[self._start:end])
+        return bytes(self._view[self._start:]) + bytes(self._view[:end - self.capacity])
+
+    def take(self):
+        """
+        Removes and returns everything in the buffer.
+        """
+        data = self.peek()
+        self._start = self._size = 0
+        return data
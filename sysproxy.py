@@ -14,14 +14,39 @@ which will cause the proxy to write the string (minus leading '>') to the associ
 Limitations
 -----------
 
-* The proxy never sends messages to a bottle process.
+* The proxy only ever sends acknowledgements back to a bottle process; everything else goes straight to slack.
 * If you want to send further input to a process, you must create a slack thread that will be associated with the process.
 * We don't currently capture the `stderr` of the long lived processes, but we may in the future.
+
+Sharding
+--------
+
+Several proxies can share the load by listing one address per proxy in `SYSPROXY_ADDR`
+and starting each with the index of its address, e.g. `python sysproxy.py 1`.
+Commands for a thread always go to the same proxy, while `ps` and `kill` are sent to all of them.
+
+The proxies don't know about each other's processes, so every limit is enforced by each proxy on its own.
+`MAX_PROCESSES` is for all of them together: each proxy allows its share, rounded up, as threads are spread evenly.
+`MAX_PROCESSES_PER_USER` applies to each proxy separately, so a user may have that many games on every proxy.
+
+Restarting
+----------
+
+Start the new proxy with `--takeover`, e.g. `python sysproxy.py 1 --takeover`, while the old one is still running.
+The old proxy posts what waiting output its Slack queues have room for and passes its processes' file descriptors,
+along with any output it couldn't post, over a Unix socket (`SYSPROXY_HANDOFF`).
+The socket lives in a directory only the proxies' user may use, `$XDG_RUNTIME_DIR` or `/tmp/hmbot-<uid>`,
+and each proxy checks that the other runs as the same user.
+Once the new proxy has adopted them, the old one lets go of the command socket, finishes its queued posts and exits.
+Adopted processes keep running, but their exit status is lost and they are only noticed to exit at housekeeping.
 """
 
-import logging, subprocess, sys, os, pty, time, select, fcntl, textwrap, datetime
-import zmq
-import api.slack
+import logging, subprocess, sys, os, pty, queue, time, fcntl, textwrap, datetime, threading, signal, resource, selectors, codecs, socket, struct, array, base64
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import zmq, ujson
+import channel, metrics, tracing, api.slack
+from ringbuffer import RingBuffer
 
 api.slack.token = os.environ['SLACK_TOKEN']
 
@@ -29,7 +54,153 @@ logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('sysproxy')
 logger.setLevel(logging.DEBUG)
 
-processes = {}
+class ProcessRegistry:
+    """
+    The live processes, indexed by pid, by the thread they are attached to and by the user who created them.
+    All of the indexes are updated together under one lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._by_pid = {}
+        self._by_thread = {}
+        self._by_creator = {}
+
+    def add(self, process):
+        with self._lock:
+            self._by_pid[process.pid] = process
+            self._by_thread[process.thread_id] = process
+            self._by_creator.setdefault(process.created_by, {})[process.pid] = process
+
+    def remove(self, pid):
+        """
+        Removes and returns the process with `pid`, or `None` if there is no such process.
+        """
+        with self._lock:
+            process = self._by_pid.pop(pid, None)
+            if process is None:
+                return None
+            if self._by_thread.get(process.thread_id) is process:
+                del self._by_thread[process.thread_id]
+            owned = self._by_creator.get(process.created_by, {})
+            owned.pop(pid, None)
+            if not owned:
+                self._by_creator.pop(process.created_by, None)
+            return process
+
+    def get(self, pid):
+        return self._by_pid.get(pid)
+
+    def for_thread(self, thread_id):
+        return self._by_thread.get(thread_id)
+
+    def for_creator(self, user):
+        with self._lock:
+            return list(self._by_creator.get(user, {}).values())
+
+    def __len__(self):
+        return len(self._by_pid)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._by_pid.values()))
+
+processes = ProcessRegistry()
+
+class Poller(zmq.Poller):
+    """
+    A `zmq.Poller` that returns the objects registered with it.
+    `zmq.Poller` itself returns only the file descriptor for anything that isn't a ZeroMQ socket.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._objects = {}
+
+    def register(self, obj, flags=zmq.POLLIN):
+        super().register(obj, flags)
+        if not isinstance(obj, (int, zmq.Socket)):
+            self._objects[obj.fileno()] = obj
+
+    def unregister(self, obj):
+        super().unregister(obj)
+        if not isinstance(obj, (int, zmq.Socket)) and self._objects.get(obj.fileno()) is obj:
+            del self._objects[obj.fileno()]
+
+    def poll(self, timeout=None):
+        return [(self._objects.get(item, item), events) for (item, events) in super().poll(timeout)]
+
+# Waits on the command socket and every process's PTY at once.
+poller = Poller()
+
+# Output is held back until a process has been quiet for `quiet` seconds,
+# `max_delay` seconds have passed since the first unsent output or `flush_size` bytes are waiting.
+# Output that is due while its thread's Slack queue is full stays put and is tried again `retry` seconds later.
+coalesce = {
+    'quiet' : float(os.environ.get('COALESCE_QUIET', 0.5)),
+    'max_delay' : float(os.environ.get('COALESCE_MAX_DELAY', 2.0)),
+    'flush_size' : int(os.environ.get('COALESCE_SIZE', 3000)),
+    'retry' : 0.5,
+}
+
+# Slack truncates longer messages.
+message_limit = 4000
+
+# Processes idle for longer than `idle_timeout` seconds are killed, at most `max_processes` may run at once across all shards,
+# and each user may only have `max_per_user` of them on each shard.  Every child gets `cpu_seconds` of CPU and `memory` bytes of address space.
+limits = {
+    'idle_timeout' : float(os.environ.get('IDLE_TIMEOUT', 6 * 60 * 60)),
+    'max_processes' : int(os.environ.get('MAX_PROCESSES', 20)),
+    'max_per_user' : int(os.environ.get('MAX_PROCESSES_PER_USER', 3)),
+    'cpu_seconds' : int(os.environ.get('CHILD_CPU_SECONDS', 10 * 60)),
+    'memory' : int(os.environ.get('CHILD_MEMORY_MB', 256)) * 1024 * 1024,
+}
+
+live_processes = metrics.Gauge('sysproxy_processes', "Live processes.", function=lambda: len(processes))
+process_posts = metrics.Gauge('sysproxy_process_posts', "Messages posted by each live process.", labels=('pid',),
+    function=lambda: {(str(p.pid),) : p.posts for p in processes})
+pty_read_bytes = metrics.Counter('sysproxy_pty_read_bytes_total', "Bytes read from the PTYs of processes.")
+dropped_bytes = metrics.Counter('sysproxy_output_dropped_bytes_total', "Output dropped because a process's buffer was full.")
+posts_total = metrics.Counter('sysproxy_posts_total', "Messages posted with process output.")
+command_seconds = metrics.Histogram('sysproxy_command_seconds', "Time spent handling commands, by command.", labels=('command',))
+
+# Serves `/metrics` on this port plus the shard's index.
+metrics_port = int(os.environ.get('SYSPROXY_METRICS_PORT', 9150))
+
+# Each process's unposted output is held in a buffer of `buffer` bytes.  When it is full, the `overflow` policy
+# either `drop`s the oldest output, `pause`s reading so that the child blocks on writing, or `kill`s the process.
+# The last `scrollback` characters that were posted can be fetched again.
+output_limits = {
+    'buffer' : int(os.environ.get('OUTPUT_BUFFER_BYTES', 64 * 1024)),
+    'overflow' : os.environ.get('OUTPUT_OVERFLOW', 'drop'),
+    'scrollback' : int(os.environ.get('SCROLLBACK_CHARS', 16 * 1024)),
+}
+
+# A running sysproxy hands its processes over to a new one started with `--takeover` through this Unix socket.
+# Its directory must belong to the sysproxy's user and not be writable by anyone else.
+handoff_path = os.environ.get('SYSPROXY_HANDOFF', os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or f'/tmp/hmbot-{os.getuid()}', 'hmbot-sysproxy-{shard}.sock'))
+handoff_timeout = 5.0
+
+# One-shot commands run on `short_workers` threads, so they can't hold up the main loop.
+# At most `max_pending` of them may be running or waiting at once.  Each is killed after `timeout` seconds
+# or once it has written more than `max_output` bytes.
+short_limits = {
+    'workers' : int(os.environ.get('SHORT_WORKERS', 4)),
+    'max_pending' : int(os.environ.get('SHORT_MAX_PENDING', 16)),
+    'timeout' : float(os.environ.get('SHORT_TIMEOUT', 30)),
+    'max_output' : int(os.environ.get('SHORT_MAX_OUTPUT', 64 * 1024)),
+}
+short_executor = None
+short_pending = 0
+short_lock = threading.Lock()
+
+short_seconds = metrics.Histogram('sysproxy_short_process_seconds', "How long one-shot commands ran.")
+short_total = metrics.Counter('sysproxy_short_processes_total', "One-shot commands, by outcome.", labels=('outcome',))
+
+# How often to look for idle and exited processes, in seconds.
+housekeeping_interval = 60
+housekeeping_due = 0
 
 class WidthHeuristic:
     def __init__(self, width):
@@ -42,53 +213,260 @@ heuristics = {
     'width' : WidthHeuristic
 }
 
+class AdoptedHandle:
+    """
+    Stands in for the `Popen` of a child that was started by an earlier sysproxy.
+    We aren't its parent, so it can't be waited for and its exit status is unknown.
+    """
+
+    def __init__(self, pid, stdin):
+        self.pid = pid
+        self.stdin = stdin
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and not self._alive():
+            self.returncode = -1
+        return self.returncode
+
+    def _alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        # An exited child stays a zombie until whoever inherited it reaps it.
+        try:
+            with open(f"/proc/{self.pid}/stat") as f:
+                return f.read().rpartition(')')[2].split()[0] != 'Z'
+        except (OSError, IndexError):
+            return True
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def wait(self, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        while self.poll() is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.returncode
+
 class Process:
-    def __init__(self, msg, handle, stdout, fid, slv):
+    def __init__(self, msg, handle, fid, slv):
         self._fid = fid
         self._slv = slv
         self._msg = msg
         self._handle = handle
-        self._stdout = stdout
+        self._output = RingBuffer(output_limits['buffer'])
+        self._decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        self._scrollback = deque()
+        self._scrollback_size = 0
 
         heurs = msg.get('heuristics', {}).items()
         self._heuristics = tuple(heuristics[key](value) for (key, value) in heurs)
 
         self.pid = self._handle.pid
+        self.thread_id = msg['thread_id']
         self.tid = msg['slack_msg']['ts']
         self.created_by = msg['slack_msg']['user']
         self.created_time = datetime.datetime.now()
         self.last_active = self.created_time
         self.command = msg['input']
 
+        self._first_output = None
+        self._last_output = None
+        self.reads = 0
+        self.posts = 0
+        self.dropped = 0
+        self.paused = False
+        self.overflowed = False
+        self._retry_at = 0
+        self.traced(msg['slack_msg'].get('trace'))
+        self._closed = False
+
     def fileno(self):
         return self._fid
 
     def read(self):
-        out = self._stdout.read()
+        """
+        Reads whatever output is available and fits into the buffer, and holds on to it until `flush`.
+        What happens when the buffer is full is up to the `overflow` policy in `output_limits`.
+        """
+        self.reads += 1
+        if not self._output.free:
+            policy = output_limits['overflow']
+            if policy == 'pause':
+                self.paused = True
+                return
+            if policy == 'kill':
+                self.overflowed = True
+                return
+            # Make room for a good chunk of output, rather than a byte at a time.
+            dropped = self._output.discard(max(4096, self._output.capacity // 4))
+            self._decoder.reset()
+            self.dropped += dropped
+            dropped_bytes.inc(dropped)
+        try:
+            n = self._output.read_from(self._fid)
+        except BlockingIOError:
+            return
+        if n:
+            pty_read_bytes.inc(n)
+            if self._awaiting_output:
+                tracing.record(self.trace, 'child_output', self._awaiting_output, pid=self.pid)
+                self._awaiting_output = None
+            now = time.monotonic()
+            if self._first_output is None:
+                self._first_output = now
+            self._last_output = now
+            self.last_active = datetime.datetime.now()
+
+    def traced(self, context):
+        """
+        Attributes the next output to the trace `context`, see `tracing`.
+        """
+        self.trace = context
+        self._awaiting_output = time.time() if context else None
+
+    def deadline(self):
+        """
+        When the held output should be flushed, or `None` if there is none.
+        """
+        if not self._output:
+            return None
+        if len(self._output) >= coalesce['flush_size'] or not self._output.free:
+            return max(self._last_output, self._retry_at)
+        return max(min(self._last_output + coalesce['quiet'], self._first_output + coalesce['max_delay']), self._retry_at)
+
+    def defer(self, seconds):
+        """
+        Holds on to the output for at least another `seconds`.
+        """
+        self._retry_at = time.monotonic() + seconds
+
+    def pending_posts(self):
+        """
+        How many messages `flush` would return at most.
+        """
+        return len(self._output) // message_limit + 1
+
+    def flush(self):
+        """
+        Returns the held output as a list of messages that each fit in a Slack message.
+        """
+        # Characters split across reads stay in the decoder until the rest arrives.
+        out = self._decoder.decode(self._output.take())
+        # The terminal turns every newline into `\r\n`, and Slack shows the `\r`.
+        out = out.replace('\r\n', '\n')
+        self._first_output = None
+        if self.dropped:
+            out = f"[{self.dropped} bytes of output were dropped]\n" + out
+            self.dropped = 0
         if 'width' in self._msg:
             width = self._msg['width']
             out = '\n'.join(textwrap.wrap(out, width))
-        self._last_active = datetime.datetime.now()
-        return out
+        self._remember(out)
+        messages = split_message(out, message_limit)
+        self.posts += len(messages)
+        posts_total.inc(len(messages))
+        return messages
+
+    def _remember(self, out):
+        limit = output_limits['scrollback']
+        self._scrollback.append(out)
+        self._scrollback_size += len(out)
+        while self._scrollback_size > limit:
+            excess = self._scrollback_size - limit
+            oldest = self._scrollback[0]
+            if len(oldest) <= excess:
+                self._scrollback.popleft()
+                self._scrollback_size -= len(oldest)
+            else:
+                self._scrollback[0] = oldest[excess:]
+                self._scrollback_size -= excess
+
+    def scrollback(self, limit=None):
+        """
+        The most recently posted output, at most `limit` characters of it.
+        """
+        text = ''.join(self._scrollback)
+        return text[-limit:] if limit else text
 
     def write(self, text):
-        text = bytes(msg['input'], encoding='utf8')
+        text = bytes(text, encoding='utf8')
         self._handle.stdin.write(text)
         self._handle.stdin.flush()
         self.last_active = datetime.datetime.now()
 
-    def __del__(self):
+    def idle(self, now):
+        """
+        Seconds since the process last read or wrote anything.
+        """
+        return (now - self.last_active).total_seconds()
+
+    def close(self):
+        """
+        Kills the process if it is still running, reaps it and closes its file descriptors.
+        """
+        if self._closed:
+            return
+        self._closed = True
         logger.debug(f"Destroying process #{self.pid}")
-        if not self._handle.poll():
+        if self._handle.poll() is None:
             self._handle.kill()
+            self._handle.wait()
         os.close(self._fid)
         os.close(self._slv)
+        self._handle.stdin.close()
+
+    def state(self):
+        """
+        What another sysproxy needs to know to adopt this process, along with `fds`.
+        """
+        return {
+            'msg' : channel.slim(self._msg),
+            'pid' : self.pid,
+            'created' : self.created_time.timestamp(),
+            'last_active' : self.last_active.timestamp(),
+            'reads' : self.reads,
+            'posts' : self.posts,
+            'scrollback' : self.scrollback(),
+            # Output that couldn't be posted yet, including characters split across reads.
+            'output' : base64.b64encode(self._decoder.getstate()[0] + self._output.peek()).decode('ascii'),
+            'dropped' : self.dropped,
+        }
 
-def check_for_thread_id(thread_id):
-    for p in processes.values():
-        if p._msg['thread_id'] == thread_id:
-            return p
-    return False
+    def fds(self):
+        return [self._fid, self._slv, self._handle.stdin.fileno()]
+
+    def detach(self):
+        """
+        Closes our copies of the file descriptors without killing the process, once another sysproxy has adopted it.
+        """
+        self._closed = True
+        os.close(self._fid)
+        os.close(self._slv)
+        self._handle.stdin.close()
+
+    def __del__(self):
+        self.close()
+
+def split_message(text, limit):
+    """
+    Splits `text` into pieces no longer than `limit`, at line breaks where possible.
+    """
+    messages = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        messages.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text:
+        messages.append(text)
+    return messages
 
 def errors_to_attachments(errors):
     attachments = []
@@ -101,63 +479,127 @@ def errors_to_attachments(errors):
         })
     return attachments
 
-def processes_to_attachments(processes):
-    attachments = []
-    for p in processes:
-        attachments.append({
-            "fallback" : "process",
-            "pretext" : p.command,
-            "fields" : [
-                {
-                    "title" : "Created",
-                    "value" : api.slack.datetime_to_slacktime(p.created_time),
-                    "short" : True
-                },
-                {
-                    "title" : "Creator",
-                    "value" : "@" + p.created_by,
-                    "short" : True
-                },
-                {
-                    "title" : "Last Active",
-                    "value" : api.slack.datetime_to_slacktime(p.last_active),
-                    "short" : True
-                },
-                {
-                    "title" : "PID",
-                    "value" : p.pid,
-                    "short" : True
-                }
-            ]
-        })
-    return attachments
+def describe(p):
+    """
+    Summarizes a process for `ps`.  The endpoint turns these into attachments.
+    """
+    return {
+        'command' : p.command,
+        'created' : p.created_time.timestamp(),
+        'created_by' : p.created_by,
+        'last_active' : p.last_active.timestamp(),
+        'pid' : p.pid,
+        'reads' : p.reads,
+        'posts' : p.posts,
+    }
 
 def apply_heuristics(text, heuristics):
     for e in heuristics:
         text = e.apply(text)
     return text
 
-def send_errors(msg, text, errors):
+def post(msg, text, block=False, **kwargs):
+    """
+    Posts to Slack through the scheduler.  The main loop must never wait for room in its queue,
+    so unless `block` is set a message for a channel whose queue is full is dropped and `False` returned.
+    """
+    try:
+        api.slack.respond(msg, text, block=block, **kwargs)
+        return True
+    except queue.Full:
+        logger.warning(f"Slack queue for {msg.get('channel')} is full, dropping a message.")
+        return False
+
+def send_errors(msg, text, errors, block=False):
     if isinstance(errors, str):
         errors = [errors]
     attachments = errors_to_attachments(errors)
-    api.slack.respond(msg, text, attachments=attachments)
+    post(msg, text, block=block, attachments=attachments)
 
 def ps(msg):
-    attachments = processes_to_attachments(processes.values())
-    api.slack.respond(
-        msg['slack_msg'], "There are %d active processes." % len(processes),
-        attachments=attachments,
-        thread_ts=msg['thread_id'])
+    """
+    Returns summaries of this shard's processes, which the endpoint merges with those of the other shards.
+    """
+    # Optionally only list the processes created by one user.
+    listed = processes.for_creator(msg['user']) if msg.get('user') else list(processes)
+    return {'processes' : [describe(p) for p in listed]}
+
+def retire(process, reason=None):
+    """
+    Removes `process`, posts whatever output it left behind and `reason` to its thread, and closes it.
+    """
+    processes.remove(process.pid)
+    try:
+        poller.unregister(process)
+    except KeyError:
+        pass
+    try:
+        process.read()
+    except:
+        pass
+    try:
+        for out in process.flush():
+            post(process._msg['slack_msg'], out, thread_ts=process.tid)
+        if reason:
+            post(process._msg['slack_msg'], reason, thread_ts=process.tid)
+    except:
+        logger.exception(f"Problem posting the last output of process #{process.pid}.")
+    process.close()
+
+def reap():
+    """
+    Retires every process whose child has exited.
+    """
+    for p in processes:
+        code = p._handle.poll()
+        if code is not None:
+            logger.info(f"Process #{p.pid} exited with {code}.")
+            retire(p, f"The process has exited ({code}).")
+
+def evict_idle():
+    """
+    Retires every process that has been idle for longer than the idle timeout.
+    """
+    now = datetime.datetime.now()
+    for p in processes:
+        if p.idle(now) > limits['idle_timeout']:
+            logger.info(f"Process #{p.pid} has been idle for {p.idle(now):.0f}s, killing it.")
+            retire(p, "I stopped this game because nobody has played it in a while :zzz:")
+
+def housekeeping():
+    global housekeeping_due
+    reap()
+    evict_idle()
+    housekeeping_due = time.monotonic() + housekeeping_interval
+
+def install_reaper():
+    """
+    Makes SIGCHLD wake up the poller, by writing to a pipe that it returns the read end of.
+    """
+    rfd, wfd = os.pipe()
+    for fd in (rfd, wfd):
+        fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+    signal.set_wakeup_fd(wfd)
+    # A Python level handler is needed for the wakeup fd to be written to.
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    poller.register(rfd, zmq.POLLIN)
+    return rfd
+
+def apply_rlimits(pid):
+    try:
+        resource.prlimit(pid, resource.RLIMIT_CPU, (limits['cpu_seconds'], limits['cpu_seconds']))
+        resource.prlimit(pid, resource.RLIMIT_AS, (limits['memory'], limits['memory']))
+    except (OSError, ValueError):
+        logger.exception(f"Could not limit the resources of process #{pid}.")
 
 def kill(msg):
-    pid = msg['pid']
-    process = processes.get(pid)
+    """
+    Kills the process with `pid` if this shard owns it.  The endpoint tells the user whether any shard did.
+    """
+    process = processes.get(msg['pid'])
     if process:
-        del processes[pid]
-        api.slack.respond(msg['slack_msg'], ":skull:")
-    else:
-        api.slack.respond(msg['slack_msg'], "No such process.")
+        retire(process)
+    return {'killed' : bool(process)}
 
 def create_process(msg):
     if 'thread_id' not in msg:
@@ -165,64 +607,204 @@ def create_process(msg):
         # wait for it to die, and then respond to the channel with its output.
         create_short_process(msg)
     else:
-        create_long_process(msg)
+        return create_long_process(msg)
+
+def shard_share(total):
+    """
+    This shard's part of a limit on all shards together.
+    """
+    return -(-total // len(channel.shards))
 
 def create_long_process(msg):
+    """
+    Starts a process attached to the message's thread, unless a limit is in the way, in which case the thread is told why.
+    Returns whether it was `created`, for the acknowledgement.
+    """
     thread_id = msg['thread_id']
-    process = check_for_thread_id(thread_id)
+    process = processes.for_thread(thread_id)
     if process:
         error = f"A process is already associated with this thread id: {thread_id} -> {process.pid}."
         logger.error(error)
         attachments = errors_to_attachments([error])
-        api.slack.respond(msg['slack_msg'], "No can do amigo!", attachments=attachments, thread_ts=thread_id)
-        return
+        post(msg['slack_msg'], "No can do amigo!", attachments=attachments, thread_ts=thread_id)
+        return {'created' : False}
+    user = msg['slack_msg']['user']
+    if len(processes) >= shard_share(limits['max_processes']):
+        post(msg['slack_msg'], "Sorry, I'm running too many things already. Try again later!", thread_ts=thread_id)
+        return {'created' : False}
+    if len(processes.for_creator(user)) >= limits['max_per_user']:
+        post(msg['slack_msg'], "You have too many games going already. Finish one first!", thread_ts=thread_id)
+        return {'created' : False}
     args = msg['input']
     master, slave = pty.openpty()
     process = subprocess.Popen(args, bufsize=0, stdin=subprocess.PIPE, stdout=slave, close_fds=True)
+    apply_rlimits(process.pid)
     fcntl.fcntl(master, fcntl.F_SETFL, os.O_NONBLOCK)
-    stdout = os.fdopen(master)
 
-    process = Process(msg, process, stdout, master, slave)
-    processes[process.pid] = process
+    process = Process(msg, process, master, slave)
+    processes.add(process)
+    poller.register(process, zmq.POLLIN)
+    return {'created' : True}
 
 def create_short_process(msg):
-    args = msg.get('input')
-    if args:
-        process = subprocess.Popen(args, bufsize=0, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    else:
-        process = subprocess.Popen(args, bufsize=0, stdout=subprocess.PIPE)
-    stdout, stderr = process.communicate(bytes(args, encoding='utf8'))
-    toapply = tuple(heuristics[key](value) for (key, value) in msg.get('heuristics', {}).items())
-    for f in toapply:
-        stdout = f(stdout)
-        stderr = f(stderr)
-    if stderr:
-        send_errors(msg['slack_msg'], "Oh no, it looks like something bad happened.", stderr)
-    else:
-        api.slack.respond(msg['slack_msg'], stdout)
+    """
+    Runs a one-shot command on `short_executor` and posts its output once it finishes.
+    """
+    global short_executor, short_pending
+    with short_lock:
+        if short_pending >= short_limits['max_pending']:
+            short_total.inc(labels=('rejected',))
+            post(msg['slack_msg'], "Sorry, I'm running too many things already. Try again later!")
+            return
+        short_pending += 1
+        if short_executor is None:
+            short_executor = ThreadPoolExecutor(short_limits['workers'])
+    short_executor.submit(run_short_process, msg)
+
+def run_short_process(msg):
+    global short_pending
+    try:
+        with short_seconds.time(), tracing.span(msg['slack_msg'].get('trace'), 'short_process'):
+            outcome, stdout, stderr = communicate(msg.get('input'), short_limits['timeout'], short_limits['max_output'])
+        short_total.inc(labels=(outcome,))
+        toapply = tuple(heuristics[key](value) for (key, value) in msg.get('heuristics', {}).items())
+        stdout = apply_heuristics(stdout.decode('utf8', 'replace'), toapply)
+        stderr = apply_heuristics(stderr.decode('utf8', 'replace'), toapply)
+        if outcome == 'timeout':
+            stderr += f"\nStopped after {short_limits['timeout']:.0f}s."
+        elif outcome == 'truncated':
+            stderr += f"\nStopped after {short_limits['max_output']} bytes of output."
+        if stderr:
+            send_errors(msg['slack_msg'], "Oh no, it looks like something bad happened.", stderr, block=True)
+        else:
+            for out in split_message(stdout, message_limit):
+                post(msg['slack_msg'], out, block=True)
+    except:
+        logger.exception(f"Problem running {msg.get('input')}.")
+    finally:
+        with short_lock:
+            short_pending -= 1
+
+def communicate(args, timeout, max_output):
+    """
+    Runs `args`, which is also written to its stdin, and collects its output.
+    Returns whether it finished `ok`, ran into the `timeout` or was `truncated`, and its stdout and stderr.
+    """
+    process = subprocess.Popen(args, bufsize=0, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    apply_rlimits(process.pid)
+    try:
+        process.stdin.write(bytes(args, encoding='utf8'))
+    except BrokenPipeError:
+        pass
+    process.stdin.close()
+
+    deadline = time.monotonic() + timeout
+    outputs = {process.stdout : [], process.stderr : []}
+    size = 0
+    outcome = 'ok'
+    with selectors.DefaultSelector() as selector:
+        for pipe in outputs:
+            selector.register(pipe, selectors.EVENT_READ)
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                outcome = 'timeout'
+                break
+            for key, _ in selector.select(remaining):
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    continue
+                outputs[key.fileobj].append(chunk)
+                size += len(chunk)
+            if size > max_output:
+                outcome = 'truncated'
+                break
+    if outcome != 'ok':
+        process.kill()
+    process.wait()
+    process.stdout.close()
+    process.stderr.close()
+    stdout, stderr = (b''.join(outputs[pipe])[:max_output] for pipe in (process.stdout, process.stderr))
+    return outcome, stdout, stderr
+
+def next_timeout():
+    """
+    Milliseconds until some process's output is due to be posted or housekeeping is due.
+    """
+    deadlines = [d for d in (p.deadline() for p in processes) if d is not None]
+    deadlines.append(housekeeping_due)
+    return max(0, (min(deadlines) - time.monotonic()) * 1000)
+
+def post_output(p):
+    """
+    Posts the held output of `p`.  If its thread's Slack queue hasn't got room for all of it,
+    the output stays in the process's buffer, where the overflow policy bounds it, and `False` is returned.
+    """
+    msg = dict(p._msg['slack_msg'], trace=p.trace)
+    scheduler = api.slack.scheduler
+    if scheduler is not None and scheduler.room(msg.get('channel')) < p.pending_posts():
+        p.defer(coalesce['retry'])
+        return False
+    try:
+        for out in p.flush():
+            post(msg, out, thread_ts=p.tid)
+        p.trace = None
+    except:
+        logger.exception(f"Problem posting output of process #{p.pid}.")
+    return True
 
-def pump():
-    rr, _, _ = select.select(processes.values(), (), (), 1)
-    if rr:
-        logger.debug("Pumping '%d' pipes...", len(rr))
-    for p in rr:
+def pump(ready):
+    """
+    Reads output from the `ready` processes and posts the output that is due.
+    """
+    if ready:
+        logger.debug("Pumping '%d' pipes...", len(ready))
+    for p in ready:
+        # It may have been retired earlier in this iteration, by `reap`, `kill` or an overflow,
+        # and its fd closed or even reused by a new process.
+        if processes.get(p.pid) is not p:
+            continue
         try:
-            out = p.read()
-            if out:
-                api.slack.respond(msg['slack_msg'], out, thread_ts=p.tid)
+            p.read()
         except:
+            # A PTY whose child has gone away stays readable, so stop polling it.
             logger.exception(f"Problem reading from process #{p.pid}.")
-    if rr:
+            try:
+                poller.unregister(p)
+            except KeyError:
+                pass
+            continue
+        if p.overflowed:
+            logger.info(f"Process #{p.pid} filled its output buffer, killing it.")
+            retire(p, "I stopped this game because it was talking way too much.")
+        elif p.paused:
+            # Stop polling until there is room again, or the full PTY would keep waking us up.
+            poller.unregister(p)
+    now = time.monotonic()
+    for p in processes:
+        deadline = p.deadline()
+        if deadline is None or deadline > now:
+            continue
+        if post_output(p) and p.paused:
+            p.paused = False
+            poller.register(p, zmq.POLLIN)
+    if ready:
         logger.debug("... done pumping.")
-        return True
-    return False
+
+def scrollback(msg):
+    """
+    Returns the recent output of the process attached to a thread, or `None` if there is none.
+    """
+    process = processes.for_thread(msg['thread_id'])
+    return {'scrollback' : process.scrollback(msg.get('limit')) if process else None}
 
 def write_process(msg):
     """
     Writes `text` to a process.
     """
     text = msg['input']
-    process = check_for_thread_id(msg['thread_id'])
+    process = processes.for_thread(msg['thread_id'])
     if not process:
         logger.error("No process found for thread.")
         send_errors(
@@ -231,36 +813,297 @@ def write_process(msg):
             f"no process associated with this thread ({msg['thread_id']}).")
         return
     logger.debug(f"Writing '{text}' to process #{process._handle.pid}")
+    process.traced(msg['slack_msg'].get('trace'))
     process.write(text)
 
+def recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError(f"Handoff connection closed after {len(data)} of {size} bytes.")
+        data += chunk
+    return data
+
+def peer_uid(sock):
+    """
+    The user id of the process at the other end of the Unix socket `sock`.
+    """
+    _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+def check_peer(sock):
+    uid = peer_uid(sock)
+    if uid != os.getuid():
+        raise PermissionError(f"Handoff peer runs as user {uid}, not {os.getuid()}.")
+
+def listen_for_handoff(path):
+    """
+    Listens on `path` for a new sysproxy that wants to take over.
+    Creates its directory if need be, and refuses to use one that other users could tamper with.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    st = os.stat(directory)
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise PermissionError(f"{directory} must belong to user {os.getuid()} and be writable only by it.")
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    return listener
+
+def hand_off(listener, receiver, metrics_server):
+    """
+    Hands every process over to the sysproxy connecting to `listener`.
+
+    Posts what waiting output there is room for, then sends the number of processes, and for each one its state,
+    including the output still waiting, along with its PTY and stdin file descriptors,
+    which SCM_RIGHTS duplicates into the other process.
+    Sending them one process at a time keeps every message well below the kernel's limit on passed descriptors.
+    Once the new sysproxy has adopted them, closes the command socket so that it can bind it.
+    Returns `False`, and carries on, if anything fails before that.
+    """
+    conn, _ = listener.accept()
+    with conn:
+        conn.settimeout(handoff_timeout)
+        live = list(processes)
+        try:
+            check_peer(conn)
+            for p in live:
+                try:
+                    p.read()
+                except OSError:
+                    pass
+                post_output(p)
+            conn.sendall(struct.pack('!I', len(live)))
+            for p in live:
+                body = ujson.dumps(p.state()).encode('utf8')
+                fds = array.array('i', p.fds())
+                conn.sendmsg([struct.pack('!I', len(body))], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+                conn.sendall(body)
+            if recv_exactly(conn, 7) != b'adopted':
+                raise ConnectionError("Unexpected handoff reply.")
+        except:
+            logger.exception("Handoff failed, keeping the processes.")
+            return False
+        # The new sysproxy owns the processes from here on.
+        for p in live:
+            processes.remove(p.pid)
+            try:
+                poller.unregister(p)
+            except KeyError:
+                pass
+            p.detach()
+        poller.unregister(receiver)
+        receiver.close(linger=0)
+        metrics_server.shutdown()
+        metrics_server.server_close()
+        poller.unregister(listener)
+        listener.close()
+        conn.sendall(b'closed')
+    logger.info(f"Handed off {len(live)} processes.")
+    return True
+
+def adopt(state, fds):
+    """
+    Takes over a process described by `state` from another sysproxy, with the file descriptors it sent.
+    """
+    fid, slv, stdin = fds
+    fcntl.fcntl(fid, fcntl.F_SETFL, os.O_NONBLOCK)
+    handle = AdoptedHandle(state['pid'], os.fdopen(stdin, 'wb', buffering=0))
+    msg = state['msg']
+    msg['slack_msg'].pop('trace', None)
+    process = Process(msg, handle, fid, slv)
+    process.created_time = datetime.datetime.fromtimestamp(state['created'])
+    process.last_active = datetime.datetime.fromtimestamp(state['last_active'])
+    process.reads = state['reads']
+    process.posts = state['posts']
+    process._remember(state['scrollback'])
+    process.dropped = state['dropped']
+    output = base64.b64decode(state['output'])
+    if output:
+        process._output.extend(output)
+        process._first_output = process._last_output = time.monotonic()
+    processes.add(process)
+    poller.register(process, zmq.POLLIN)
+    return process
+
+def recv_fds(sock, size, count):
+    """
+    Receives `size` bytes along with up to `count` file descriptors passed with SCM_RIGHTS.
+    Raises `ConnectionError`, after closing whatever did arrive, if the descriptors didn't fit.
+    """
+    fds = array.array('i')
+    data, ancdata, flags, _ = sock.recvmsg(size, socket.CMSG_SPACE(count * fds.itemsize))
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+    if flags & socket.MSG_CTRUNC or len(fds) != count:
+        for fd in fds:
+            os.close(fd)
+        raise ConnectionError(f"Expected {count} file descriptors, got {len(fds)}{' and more were cut off' if flags & socket.MSG_CTRUNC else ''}.")
+    if not data:
+        raise ConnectionError("Handoff connection closed.")
+    return data + recv_exactly(sock, size - len(data)), list(fds)
+
+def take_over(path):
+    """
+    Asks the sysproxy listening on `path` to hand over its processes and adopts them.
+    Returns once it has closed its command socket, or right away if there is nobody to take over from.
+    Raises if the handoff fails before the other sysproxy let go of its processes, after giving back the ones adopted so far.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as ex:
+        logger.warning(f"Nothing to take over at {path} ({ex}), starting afresh.")
+        sock.close()
+        return
+    with sock:
+        check_peer(sock)
+        sock.settimeout(handoff_timeout)
+        adopted = []
+        try:
+            count, = struct.unpack('!I', recv_exactly(sock, 4))
+            for _ in range(count):
+                header, fds = recv_fds(sock, 4, 3)
+                try:
+                    state = ujson.loads(recv_exactly(sock, struct.unpack('!I', header)[0]))
+                    adopted.append(adopt(state, fds))
+                except:
+                    for fd in fds:
+                        try:
+                            os.close(fd)
+                        except OSError:
+                            pass
+                    raise
+            sock.sendall(b'adopted')
+        except:
+            # The other sysproxy keeps its processes, so let go of our copies.
+            for p in adopted:
+                processes.remove(p.pid)
+                poller.unregister(p)
+                p.detach()
+            raise
+        recv_exactly(sock, 6)
+    logger.info(f"Took over {len(adopted)} processes.")
+
+def bind_commands(context, shard, timeout=2.0):
+    """
+    Binds the command socket, retrying for a moment in case the previous sysproxy is still letting go of it.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return channel.bind(context, shard)
+        except zmq.ZMQError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+commands = {
+    'ps' : ps,
+    'kill' : kill,
+    'quit' : lambda _: sys.exit(0),
+    'write' : write_process,
+    'scrollback' : scrollback,
+    'create' : create_process,
+}
+
+def handle_commands(receiver, shard):
+    """
+    Handles every command waiting on `receiver` and acknowledges it.
+    """
+    while True:
+        try:
+            sender, batch = channel.receive(receiver, zmq.NOBLOCK)
+        except zmq.Again:
+            return
+        received = time.time()
+        for msg in batch:
+            dispatch(receiver, sender, msg, received, shard)
+
+def dispatch(receiver, sender, msg, received, shard):
+    logger.info(f"Received message: {msg}.")
+    trace = msg.get('slack_msg', {}).get('trace')
+    if trace and 'sent' in msg:
+        tracing.record(trace, 'proxy_dispatch', msg['sent'], received, shard=shard)
+    command = commands.get(msg.get('command'))
+    if not command:
+        logger.error(f"Unknown message type: {msg.get('command')}.")
+        channel.acknowledge(receiver, sender, msg, ok=False, error="unknown command")
+        return
+    try:
+        with command_seconds.time((msg['command'],)), tracing.span(trace, 'proxy_' + msg['command']):
+            result = command(msg)
+        channel.acknowledge(receiver, sender, msg, result=result)
+    except:
+        logger.exception(f"Problem handling {msg.get('command')}.")
+        channel.acknowledge(receiver, sender, msg, ok=False, error="failed")
+
 if __name__ == '__main__':
+    api.slack.configure(
+        size=int(os.environ.get('SLACK_POOL_SIZE', api.slack.pool_size)),
+        connect_timeout=float(os.environ.get('SLACK_CONNECT_TIMEOUT', api.slack.timeout[0])),
+        read_timeout=float(os.environ.get('SLACK_READ_TIMEOUT', api.slack.timeout[1])))
+    # Games can produce output much faster than Slack lets us post it.
+    api.slack.scheduler = api.slack.Scheduler().start()
+
     context = zmq.Context()
-    consumer_receiver = context.socket(zmq.PULL)
-    consumer_receiver.connect("tcp://127.0.0.1:5557")
-
-    commands = {
-        'ps' : ps,
-        'kill' : kill,
-        'quit' : lambda _: sys.exit(0),
-        'write' : write_process,
-        'create' : create_process,
-    }
+    # Run one sysproxy per address in `SYSPROXY_ADDR`, passing each its index.
+    # To restart one without stopping its games, start the new one with `--takeover`.
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    shard = int(args[0]) if args else int(os.environ.get('SYSPROXY_SHARD', 0))
+    path = handoff_path.format(shard=shard)
+    if '--takeover' in sys.argv:
+        try:
+            take_over(path)
+        except:
+            logger.exception("Could not take over, starting afresh.")
+    logger.info(f"Serving shard {shard} of {len(channel.shards)} at {channel.shards[shard]}.")
+    consumer_receiver = bind_commands(context, shard)
+    metrics_server = metrics.serve(metrics_port + shard)
+    try:
+        listener = listen_for_handoff(path)
+    except OSError:
+        logger.exception(f"Can't listen for a handoff at {path}, this sysproxy can't be taken over.")
+        listener = None
+
+    poller.register(consumer_receiver, zmq.POLLIN)
+    if listener is not None:
+        poller.register(listener, zmq.POLLIN)
+    wakeup = install_reaper()
 
     while True:
         try:
-            msg = consumer_receiver.recv_json(flags=zmq.NOBLOCK)
-            logger.info(f"Received message: {msg}.")
-            command = commands.get(msg.get('command'))
-            if command:
-                command(msg)
-            else:
-                logger.error(f"Unknown message type: {msg['type']}.")
-        except zmq.Again:
-            if not pump():
-                time.sleep(0.1)
+            events = dict(poller.poll(next_timeout()))
+            if events.pop(wakeup, None):
+                try:
+                    while os.read(wakeup, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                reap()
+            if events.pop(listener, None) and hand_off(listener, consumer_receiver, metrics_server):
+                break
+            if time.monotonic() >= housekeeping_due:
+                housekeeping()
+            if events.pop(consumer_receiver, None):
+                handle_commands(consumer_receiver, shard)
+            pump(list(events))
         except KeyboardInterrupt:
             logger.info("Quiting from keyboard interrupt.")
             break
         except:
             logger.exception("Exception reached top of main loop.")
 
+    if consumer_receiver.closed:
+        # Handed off: let running one-shot commands and queued posts finish before going away.
+        if short_executor is not None:
+            short_executor.shutdown(wait=True)
+        if not api.slack.scheduler.drain(timeout=30):
+            logger.warning("Exiting with Slack posts still queued.")
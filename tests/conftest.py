@@ -0,0 +1,12 @@
+"""
+Lets the tests import hmbot's modules, which live at the top of the repository,
+and gives the ones that read their settings at import time something to read.
+"""
+
+import os, sys, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('SLACK_TOKEN', 'xoxb-test')
+os.environ.setdefault('VERIFICATION_TOKEN', 'test')
+os.environ.setdefault('SQLITE_DB', os.path.join(tempfile.mkdtemp(prefix='hmbot-test-'), 'test.db'))
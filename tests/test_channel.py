@@ -0,0 +1,40 @@
+import threading
+import pytest, zmq
+import channel
+
+@pytest.fixture
+def proxies():
+    """
+    Two inproc shards that acknowledge every command with the shard's index and the number of frames it came in.
+    """
+    context = zmq.Context()
+    endpoints = [f"inproc://test-channel-{shard}" for shard in range(2)]
+    stop = threading.Event()
+    def serve(shard, receiver):
+        while not stop.is_set():
+            if receiver.poll(50):
+                sender, batch = channel.receive(receiver)
+                for command in batch:
+                    channel.acknowledge(receiver, sender, command, result={'shard' : shard, 'frames' : len(batch)})
+        receiver.close(linger=0)
+    threads = []
+    for shard, endpoint in enumerate(endpoints):
+        receiver = context.socket(zmq.ROUTER)
+        receiver.bind(endpoint)
+        threads.append(threading.Thread(target=serve, args=(shard, receiver), daemon=True))
+    for thread in threads:
+        thread.start()
+    yield channel.Client(context, endpoints=endpoints)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+def test_request_many_sends_one_message_per_shard_and_keeps_the_order(proxies):
+    threads = [str(i) for i in range(10)]
+    acks = proxies.request_many([{'command' : 'write', 'thread_id' : thread} for thread in threads], timeout=5)
+
+    assert [ack['shard'] for ack in acks] == [channel.shard_for(thread, 2) for thread in threads]
+    for shard in range(2):
+        owned = sum(1 for thread in threads if channel.shard_for(thread, 2) == shard)
+        assert all(ack['frames'] == owned for ack in acks if ack['shard'] == shard)
+    assert len({ack['id'] for ack in acks}) == len(threads)
@@ -0,0 +1,125 @@
+import threading, socketserver, time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import pytest, requests
+import api.slack
+
+class FakeSlackHandler(BaseHTTPRequestHandler):
+    # Keeps connections open between requests, like slack.com does.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.calls += 1
+        body = b'{"ok": true, "ts": "1546300800.000100"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeSlack(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    Answers every Web API call with `ok` and counts the connections opened to it,
+    each of which would have been a TLS handshake with the real Slack.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeSlackHandler)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.connections = 0
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/api/"
+
+@pytest.fixture
+def slack(monkeypatch):
+    server = FakeSlack()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(api.slack, 'base_url', server.url)
+    monkeypatch.setattr(api.slack, 'pool_size', api.slack.pool_size)
+    # Start from a fresh pool, mounted for the fake's address.
+    api.slack.configure()
+    yield server
+    api.slack.configure()
+    server.shutdown()
+    server.server_close()
+
+def post_messages(count):
+    for i in range(count):
+        api.slack.call('chat.postMessage', channel='C0TEST', text=f"message {i}")
+
+def test_calls_share_one_connection(slack):
+    post_messages(20)
+
+    assert slack.calls == 20
+    assert slack.connections == 1
+    stats = api.slack.pool_stats()
+    assert stats['requests'] == 20
+    assert stats['connections'] == 1
+    assert stats['reuse'] == pytest.approx(0.95)
+    assert stats['in_flight'] == 0
+
+def test_pool_saves_a_handshake_per_call(slack):
+    for i in range(20):
+        requests.post(slack.url + 'chat.postMessage', data={'channel' : 'C0TEST', 'text' : f"message {i}"})
+    unpooled = slack.connections
+
+    slack.connections = 0
+    post_messages(20)
+
+    assert unpooled == 20
+    assert slack.connections == 1
+
+def test_concurrent_calls_stay_within_the_pool_size(slack):
+    api.slack.configure(size=2)
+    threads = [threading.Thread(target=post_messages, args=(10,)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert slack.calls == 60
+    assert slack.connections <= 2
+    assert api.slack.pool_stats()['size'] == 2
+
+def test_rate_limited_call_is_retried_after_its_channel_was_recreated(monkeypatch):
+    calls = []
+    started = {'first' : threading.Event(), 'other' : threading.Event()}
+    release = {'first' : threading.Event(), 'other' : threading.Event()}
+    def call(method, **kwargs):
+        text = kwargs['text']
+        calls.append(text)
+        if text in started and calls.count(text) == 1:
+            started[text].set()
+            release[text].wait(5)
+            if text == 'first':
+                raise api.slack.RateLimited(method, 0.01)
+    monkeypatch.setattr(api.slack, 'call', call)
+    # A second sending thread keeps the scheduler going while the first call is in flight.
+    scheduler = api.slack.Scheduler(rate=100, burst=1).start().start()
+
+    scheduler.submit('chat.postMessage', channel='C0TEST', text='first')
+    assert started['first'].wait(5)
+    # While the first call is in flight its channel's queue is empty, so once its token is back
+    # the other thread forgets the channel, and the next call for it starts a new one.
+    time.sleep(0.05)
+    scheduler.submit('chat.postMessage', channel='C0OTHER', text='other')
+    assert started['other'].wait(5)
+    scheduler.submit('chat.postMessage', channel='C0TEST', text='second')
+    release['first'].set()
+    release['other'].set()
+
+    assert scheduler.drain(5)
+    assert calls == ['first', 'other', 'first', 'second']
@@ -0,0 +1,109 @@
+import os, stat, time, textwrap
+import pytest
+import sysproxy, api.slack
+
+@pytest.fixture
+def posts(monkeypatch):
+    """
+    Collects what sysproxy posts, as `(time, text)`, instead of sending it to Slack.
+    """
+    posted = []
+    monkeypatch.setattr(api.slack, 'scheduler', None)
+    monkeypatch.setattr(api.slack, 'respond', lambda msg, text, **kwargs: posted.append((time.monotonic(), text)))
+    monkeypatch.setattr(sysproxy, 'housekeeping_due', float('inf'))
+    monkeypatch.setitem(sysproxy.coalesce, 'quiet', 0.01)
+    monkeypatch.setitem(sysproxy.coalesce, 'max_delay', 0.05)
+    yield posted
+    for p in list(sysproxy.processes):
+        sysproxy.processes.remove(p.pid)
+        sysproxy.poller.unregister(p)
+        p.close()
+
+def script(tmpdir, name, body):
+    path = os.path.join(str(tmpdir), name)
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\n' + textwrap.dedent(body))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+def message(command, thread_id=None):
+    msg = {
+        'command' : 'create',
+        'input' : command,
+        'slack_msg' : {'channel' : 'C0TEST', 'ts' : '1.0', 'user' : 'U0TEST'},
+    }
+    if thread_id:
+        msg['thread_id'] = thread_id
+    return msg
+
+def run_loop(seconds):
+    """
+    Runs the reactor part of sysproxy's main loop for `seconds`.
+    """
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        timeout = min(sysproxy.next_timeout(), (deadline - time.monotonic()) * 1000)
+        events = dict(sysproxy.poller.poll(max(0, timeout)))
+        sysproxy.pump(list(events))
+
+def test_long_process_output_keeps_flowing_while_a_short_command_runs(posts, tmpdir):
+    ticker = script(tmpdir, 'ticker', """
+        while true; do
+            echo tick
+            sleep 0.05
+        done
+    """)
+    slow = script(tmpdir, 'slow', """
+        sleep 1
+        echo done
+    """)
+
+    sysproxy.create_process(message(ticker, thread_id='1.0'))
+    started = time.monotonic()
+    sysproxy.create_process(message(slow))
+    assert time.monotonic() - started < 0.5, "creating a short command shouldn't wait for it to finish"
+
+    run_loop(1.5)
+
+    finished = [t for (t, text) in posts if 'done' in text]
+    assert finished, "the short command's output was never posted"
+    ticks = [t for (t, text) in posts if 'tick' in text and t < finished[0]]
+    # The ticker prints every 50ms and its output is posted within 50ms of arriving,
+    # so it should have been posted many times during the second the short command ran.
+    assert len(ticks) >= 5
+    assert ticks[0] - started < 0.5
+
+def test_create_acknowledges_whether_the_process_was_created(posts, monkeypatch):
+    assert sysproxy.create_process(message('cat', thread_id='2.0')) == {'created' : True}
+    assert sysproxy.create_process(message('cat', thread_id='2.0')) == {'created' : False}
+
+    monkeypatch.setitem(sysproxy.limits, 'max_processes', 1)
+    assert sysproxy.create_process(message('cat', thread_id='3.0')) == {'created' : False}
+    assert [text for (t, text) in posts] == ["No can do amigo!", "Sorry, I'm running too many things already. Try again later!"]
+
+def test_output_waiting_at_a_handoff_is_posted_by_the_adopting_sysproxy(posts, tmpdir):
+    chatty = script(tmpdir, 'chatty', """
+        printf 'caf\\303'
+        sleep 0.2
+        printf '\\251 au lait\\n'
+        sleep 10
+    """)
+    sysproxy.create_process(message(chatty, thread_id='4.0'))
+    [p] = list(sysproxy.processes)
+    deadline = time.monotonic() + 2
+    while not p._output and time.monotonic() < deadline:
+        p.read()
+        time.sleep(0.01)
+    # As if 'caf' had been posted, leaving half of the `é` in the decoder.
+    assert p._decoder.decode(p._output.take()) == 'caf'
+
+    # What `hand_off` and `take_over` do, within one sysproxy.
+    state, fds = p.state(), [os.dup(fd) for fd in p.fds()]
+    sysproxy.processes.remove(p.pid)
+    sysproxy.poller.unregister(p)
+    p.detach()
+    sysproxy.adopt(state, fds)
+
+    run_loop(0.5)
+
+    assert ''.join(text for (t, text) in posts).strip() == 'é au lait'
@@ -0,0 +1,30 @@
+import pytest
+import parser, hmbot
+from tokenizers import RuleTokenizer, SpacyTokenizer
+
+literals = sorted(parser.rule_literals(hmbot.parser.handlers))
+
+@pytest.fixture(scope='module')
+def spacy():
+    pytest.importorskip('spacy')
+    tokenizer = SpacyTokenizer()
+    try:
+        tokenizer('')
+    except (IOError, OSError) as ex:
+        pytest.skip(f"spaCy's '{tokenizer.model}' model isn't installed: {ex}")
+    return tokenizer
+
+def test_every_handler_contributes_literals():
+    for handler in hmbot.parser.handlers:
+        assert parser.rule_literals([handler]), f"{handler.func.__name__} has no literals to check"
+    assert {'hmbot', 'choose between', 'i love you', '# scrollback', '>'} <= set(literals)
+
+def test_contractions_are_split_like_spacy_does():
+    tokenize = RuleTokenizer()
+    assert tokenize("What's happening?") == ['what', "'s", 'happening', '?']
+    assert tokenize("Im hmbot") == ['i', 'm', 'hmbot']
+    assert tokenize("dont") == ['do', 'nt']
+
+@pytest.mark.parametrize('literal', literals)
+def test_rule_tokenizer_agrees_with_spacy(spacy, literal):
+    assert RuleTokenizer()(literal) == spacy(literal)
@@ -0,0 +1,156 @@
+"""
+Tokenizers that turn message text into the lowercase tokens consumed by the parser.
+
+The parser only ever looks at the text of each token, so the default `RuleTokenizer` splits
+words with a handful of rules that mirror what spaCy's English tokenizer does to our rule vocabulary.
+`SpacyTokenizer` is still available for anyone who wants the real thing, and only imports spaCy when it is first used.
+
+Run this module directly to check that both tokenizers agree on every literal used by hmbot's rules.
+"""
+
+import logging
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger('hmbot.tokenizers')
+logger.setLevel(logging.DEBUG)
+
+class RuleTokenizer:
+    """
+    Splits on whitespace, then peels punctuation and contractions off the front and back of each word.
+    """
+
+    prefixes = frozenset('"\'([{*<>$£¥€#&§%=+‘“`')
+    suffixes = frozenset('"\')]}*!?%$€£.,;:’”')
+    contractions = ("n't", "'s", "'m", "'re", "'ve", "'ll", "'d")
+
+    # Words that spaCy splits even though there is no punctuation in them.
+    # Maps the lowercase word to the lengths of its pieces.
+    exceptions = {
+        "im" : (1, 1),
+        "ive" : (1, 2),
+        "youre" : (3, 2),
+        "youve" : (3, 2),
+        "youll" : (3, 2),
+        "whats" : (4, 1),
+        "whos" : (3, 1),
+        "wheres" : (5, 1),
+        "hows" : (3, 1),
+        "thats" : (4, 1),
+        "theres" : (5, 1),
+        "dont" : (2, 2),
+        "doesnt" : (4, 2),
+        "didnt" : (3, 2),
+        "cant" : (2, 2),
+        "wont" : (2, 2),
+        "isnt" : (2, 2),
+        "arent" : (3, 2),
+        "..." : (3,),
+    }
+
+    def __call__(self, text):
+        tokens = []
+        for chunk in text.split():
+            tokens.extend(self._split(chunk))
+        return [token.lower() for token in tokens]
+
+    def _split(self, chunk):
+        prefixes, suffixes = [], []
+        middle = []
+        while chunk:
+            lengths = self.exceptions.get(chunk.lower())
+            if lengths:
+                offset = 0
+                for length in lengths:
+                    middle.append(chunk[offset:offset + length])
+                    offset += length
+                break
+            if len(chunk) > 1 and chunk[0] in self.prefixes:
+                prefixes.append(chunk[0])
+                chunk = chunk[1:]
+                continue
+            length = self._suffix(chunk)
+            if length:
+                suffixes.append(chunk[-length:])
+                chunk = chunk[:-length]
+                continue
+            middle = self._infixes(chunk)
+            break
+        return prefixes + middle + suffixes[::-1]
+
+    def _suffix(self, chunk):
+        lower = chunk.lower()
+        for contraction in self.contractions:
+            if len(chunk) > len(contraction) and lower.endswith(contraction):
+                return len(contraction)
+        if len(chunk) > 3 and chunk.endswith('...'):
+            return 3
+        if len(chunk) > 1 and chunk[-1] in self.suffixes:
+            return 1
+        return 0
+
+    def _infixes(self, chunk):
+        """
+        Splits commas and double hyphens that sit between two letters.
+        """
+        tokens = []
+        start = 0
+        i = 1
+        while i < len(chunk) - 1:
+            for infix in ('--', ','):
+                end = i + len(infix)
+                if chunk.startswith(infix, i) and end < len(chunk) and chunk[i - 1].isalpha() and chunk[end].isalpha():
+                    tokens.append(chunk[start:i])
+                    tokens.append(infix)
+                    start = end
+                    i = end
+                    break
+            else:
+                i += 1
+        tokens.append(chunk[start:])
+        return tokens
+
+class SpacyTokenizer:
+    """
+    Uses spaCy's tokenizer, without running the rest of its pipeline.
+    The model is loaded the first time a text is tokenized.
+    """
+
+    def __init__(self, model='en'):
+        self.model = model
+        self._nlp = None
+
+    def __call__(self, text):
+        if self._nlp is None:
+            import spacy
+            logger.info(f"Loading spaCy model '{self.model}'.")
+            self._nlp = spacy.load(self.model)
+        return [str(token).lower() for token in self._nlp.tokenizer(text)]
+
+backends = {
+    'rule' : RuleTokenizer,
+    'spacy' : SpacyTokenizer,
+}
+
+def from_name(name):
+    """
+    Creates a tokenizer from its name in `backends`.
+    """
+    try:
+        return backends[name]()
+    except KeyError:
+        raise ValueError(f"Unknown tokenizer '{name}', expected one of {sorted(backends)}.")
+
+if __name__ == '__main__':
+    import sys
+    import parser, hmbot
+
+    rule, spacy = RuleTokenizer(), SpacyTokenizer()
+    literals = parser.rule_literals(hmbot.parser.handlers)
+    mismatches = 0
+    for literal in sorted(literals):
+        expected, actual = spacy(literal), rule(literal)
+        if expected != actual:
+            mismatches += 1
+            print(f"{literal!r}: spacy={expected} rule={actual}")
+    print(f"{len(literals)} literals, {mismatches} mismatches.")
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,157 @@
+"""
+Follows a Slack event through the endpoint, the sysproxy and its child process with timestamped spans.
+
+`root` starts a trace for an event and returns its context, a small dict with the `trace_id` and the
+root's `span_id`.  The context travels with the Slack message under `trace`, which `channel` passes
+along to the sysproxy, so every hop can `record` spans that belong to the same trace.
+Every span is a child of the root.  Times are wall clock times, so spans from different processes on one host line up.
+
+Spans are exported as JSON lines to wherever `TRACE_EXPORT` points:
+
+  * `file:/path/to/spans.jsonl` appends them to a file,
+  * `udp://host:port` sends each one as a datagram to a collector.
+
+Without `TRACE_EXPORT` no traces are started, and every function here does nothing when given a `None` context.
+`TRACE_SAMPLE` is the fraction of events to trace.
+
+Run this module with a file of spans to print the hops of each trace.
+"""
+
+import logging, os, sys, random, socket, threading, time
+from contextlib import contextmanager
+import ujson
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger('tracing')
+logger.setLevel(logging.DEBUG)
+
+# Which process recorded a span, `endpoint` or `sysproxy` unless `TRACE_SERVICE` says otherwise.
+service = os.environ.get('TRACE_SERVICE') or os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'hmbot'
+
+sample_rate = float(os.environ.get('TRACE_SAMPLE', 1.0))
+
+class FileExporter:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = ujson.dumps(span) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+class UDPExporter:
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def export(self, span):
+        try:
+            self._socket.sendto(ujson.dumps(span).encode('utf8'), self.address)
+        except OSError as ex:
+            logger.debug(f"Dropped a span: {ex}")
+
+def exporter_for(destination):
+    """
+    Creates the exporter for a `TRACE_EXPORT` value, or returns `None` if it is empty.
+    """
+    if not destination:
+        return None
+    if destination.startswith('file:'):
+        return FileExporter(destination[len('file:'):])
+    if destination.startswith('udp://'):
+        host, port = destination[len('udp://'):].rsplit(':', 1)
+        return UDPExporter(host, int(port))
+    raise ValueError(f"Unknown trace destination '{destination}', expected file:<path> or udp://<host>:<port>.")
+
+exporter = exporter_for(os.environ.get('TRACE_EXPORT'))
+
+def new_id(bits=64):
+    return '%0*x' % (bits // 4, random.getrandbits(bits))
+
+def record(context, name, start, end=None, **attrs):
+    """
+    Records a span of the trace `context` that started at `start` and ended at `end` (defaults to now).
+    """
+    if context is None or exporter is None:
+        return
+    end = time.time() if end is None else end
+    span = dict(attrs,
+        trace_id=context['trace_id'],
+        span_id=new_id(),
+        parent_id=context['span_id'],
+        service=service,
+        name=name,
+        start=start,
+        duration=end - start)
+    try:
+        exporter.export(span)
+    except:
+        logger.exception(f"Could not export span {name}.")
+
+@contextmanager
+def root(name, **attrs):
+    """
+    Starts a trace, if this event is sampled, and yields its context or `None`.
+    The root span covers the `with` block.
+    """
+    if exporter is None or random.random() >= sample_rate:
+        yield None
+        return
+    context = {'trace_id' : new_id(128), 'span_id' : new_id()}
+    start = time.time()
+    try:
+        yield context
+    finally:
+        exporter.export(dict(attrs,
+            trace_id=context['trace_id'],
+            span_id=context['span_id'],
+            parent_id=None,
+            service=service,
+            name=name,
+            start=start,
+            duration=time.time() - start))
+
+@contextmanager
+def span(context, name, **attrs):
+    """
+    Records a span of `context` covering the `with` block.
+    """
+    if context is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(context, name, start, **attrs)
+
+def recorder(context, name, **attrs):
+    """
+    Returns a function that records a span of `context` from now until it is called, or `None` if there is no trace.
+    """
+    if context is None or exporter is None:
+        return None
+    start = time.time()
+    def done(**more):
+        record(context, name, start, **dict(attrs, **more))
+    return done
+
+if __name__ == '__main__':
+    from collections import defaultdict
+
+    traces = defaultdict(list)
+    for path in sys.argv[1:]:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    s = ujson.loads(line)
+                    traces[s['trace_id']].append(s)
+    for trace_id, spans in sorted(traces.items(), key=lambda item: min(s['start'] for s in item[1])):
+        spans.sort(key=lambda s: s['start'])
+        began = spans[0]['start']
+        print(trace_id)
+        for s in spans:
+            print(f"  {(s['start'] - began) * 1000:9.1f}ms {s['duration'] * 1000:9.1f}ms  {s['service']:>10} {s['name']}")
@@ -0,0 +1,157 @@
+"""
+Bounded pools for doing work outside of the request that asked for it,
+either on threads or as tasks on an asyncio event loop.
+"""
+
+import logging, queue, threading, time, asyncio
+
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger('workers')
+logger.setLevel(logging.DEBUG)
+
+class WorkerPool:
+    """
+    Calls `handler` on a fixed number of threads with the arguments given to `submit`.
+
+    At most `maxsize` calls wait in the queue; once it is full `submit` refuses new work instead of blocking.
+    With `workers=0` nothing is queued and `submit` calls `handler` directly.
+    """
+
+    def __init__(self, handler, workers=4, maxsize=100):
+        self.handler = handler
+        self.workers = workers
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._submitted = 0
+        self._dropped = 0
+        self._handled = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, *args, **kwargs):
+        """
+        Queues a call to `handler`.  Returns `False` if the queue is full.
+        """
+        if not self.workers:
+            self._handle(time.monotonic(), args, kwargs)
+            return True
+        try:
+            self._queue.put_nowait((time.monotonic(), args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+            logger.error(f"Work queue is full ({self._queue.maxsize}), dropping work.")
+            return False
+        with self._lock:
+            self._submitted += 1
+        return True
+
+    def stats(self):
+        with self._lock:
+            handled = self._handled or 1
+            return {
+                'workers' : self.workers,
+                'depth' : self._queue.qsize(),
+                'maxsize' : self._queue.maxsize,
+                'submitted' : self._submitted,
+                'dropped' : self._dropped,
+                'handled' : self._handled,
+                'wait_avg' : self._wait_total / handled,
+                'wait_max' : self._wait_max,
+                'latency_avg' : self._latency_total / handled,
+                'latency_max' : self._latency_max,
+            }
+
+    def _run(self):
+        while True:
+            enqueued, args, kwargs = self._queue.get()
+            try:
+                self._handle(enqueued, args, kwargs)
+            finally:
+                self._queue.task_done()
+
+    def _handle(self, enqueued, args, kwargs):
+        started = time.monotonic()
+        try:
+            self.handler(*args, **kwargs)
+        except:
+            logger.exception("Exception in worker.")
+        finished = time.monotonic()
+        wait, latency = started - enqueued, finished - enqueued
+        with self._lock:
+            self._handled += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            self._latency_total += latency
+            self._latency_max = max(self._latency_max, latency)
+        logger.debug(f"Handled work after waiting {wait:.3f}s, {latency:.3f}s since it was queued.")
+
+class AsyncWorkerPool:
+    """
+    Runs the coroutine function `handler` as a task on the event loop for each call to `submit`.
+
+    At most `maxsize` tasks run at once; beyond that `submit` refuses new work, like `WorkerPool`.
+    `submit` must be called from the event loop's thread.
+    """
+
+    def __init__(self, handler, maxsize=100):
+        self.handler = handler
+        self.maxsize = maxsize
+        self._running = 0
+        self._submitted = 0
+        self._dropped = 0
+        self._handled = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def start(self):
+        return self
+
+    def submit(self, *args, **kwargs):
+        """
+        Starts a task calling `handler`.  Returns `False` if too many are running already.
+        """
+        if self._running >= self.maxsize:
+            self._dropped += 1
+            logger.error(f"Too many tasks running ({self.maxsize}), dropping work.")
+            return False
+        self._running += 1
+        self._submitted += 1
+        asyncio.ensure_future(self._handle(time.monotonic(), args, kwargs))
+        return True
+
+    def stats(self):
+        handled = self._handled or 1
+        return {
+            'workers' : 'asyncio',
+            'depth' : self._running,
+            'maxsize' : self.maxsize,
+            'submitted' : self._submitted,
+            'dropped' : self._dropped,
+            'handled' : self._handled,
+            'latency_avg' : self._latency_total / handled,
+            'latency_max' : self._latency_max,
+        }
+
+    async def _handle(self, started, args, kwargs):
+        try:
+            await self.handler(*args, **kwargs)
+        except:
+            logger.exception("Exception in task.")
+        finally:
+            self._running -= 1
+        latency = time.monotonic() - started
+        self._handled += 1
+        self._latency_total += latency
+        self._latency_max = max(self._latency_max, latency)
+        logger.debug(f"Handled work in {latency:.3f}s.")